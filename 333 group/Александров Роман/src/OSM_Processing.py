@@ -1,127 +1,379 @@
-import pickle
+'''
+Road graph of an .osm/.pbf file. `build_graph` reads it (or takes it from
+the cache next to the file) and returns a `RoadGraph`; importing the module
+does nothing else. Run it as a script to build the graph and draw the maps.
+'''
 from collections import Counter, defaultdict
-from math import radians
-from sys import argv
+import os.path
 
 import osmread as osm
-from utm import from_latlon
+from osmread.clip import make_area, split_way
 
 from miscellaneous import pairwise
-from output_mgr import build_map, write_adj_list, write_adj_matrix
+from turn_restrictions import build_restrictions
 
-DEBUG = __name__ == "__main__"
-GUI = DEBUG
 DEFAULT_FILENAME = 'Cheboksary.osm'
-FILENAME = None
-VERSION = 0.12
-
-try:    # TODO: make a separate function
-    with open(DEFAULT_FILENAME + 'dump', 'rb') as f:
-        dump = pickle.load(f)
-        print('Found dump, opening backup')
-        if dump['dump_ver'] < VERSION:
-            print('Dump is built by older version')
-            first_read = True
-        else:
-            for k, v in dump.items():
-                vars()[k] = v
-            first_read = False
-except:
-    first_read = True
-
-
-if GUI:
-    import dialog as dd
-    if first_read:
-    # Attempting to get filename from 1 - ARGV, 2 - GUI, 3 - STDIN
-        FILENAME = next((arg for arg in argv[1:] if arg.endswith('.osm')), None)
-        if not FILENAME:
-            try:                
-                FILENAME = dd.reqestFile()
-                if not FILENAME: # ↓ also critical
-                    FILENAME = input('Absolute path to the file or just name: ')
-            except:
-                print('GUI loading failed. Looking for ".osm" file.')
+VERSION = 0.17
 
-# Attempting to get 1- PICKLE dump, 2 - original .OSM file
-if first_read:
-    if not FILENAME:
-        FILENAME = DEFAULT_FILENAME
+is_spot = lambda node: node.tags.get('amenity', None) == 'hospital' and 'name' in node.tags
+# is_spot = lambda node: node.tags.get('amenity', None) in ['hospital', 'clinic']
+# is_spot = lambda node: node.tags.get('shop', None) in ['electronics', 'computer']
+# The one filter the cache can key by its code, see `build_graph`
+_default_is_spot = is_spot
 
-    ways, nodes, spots = [], {}, []
-    is_spot = lambda node: ent.tags.get('amenity', None) == 'hospital' and 'name' in ent.tags
-    # is_spot = lambda node: ent.tags.get('amenity', None) in ['hospital', 'clinic']
-    # is_spot = lambda node: ent.tags.get('shop', None) in ['electronics', 'computer']
-
-    try:
-        for ent in osm.parse_file(FILENAME):
-            if isinstance(ent, osm.Way) and 'highway' in ent.tags:
-                ways.append(ent)
-            elif isinstance(ent, osm.Node):
-                if is_spot(ent):
-                    spots.append(ent)
-                nodes[ent.id] = ent
-
-        if DEBUG:
-            print('Done with reading. Total ways in file: {}. Total nodes: {}'.format(len(ways), len(nodes)))
-    except FileNotFoundError:
-        from sys import exit
-        exit('This program just need the file :(')
+is_useful = lambda node_id, node_ways: (len(node_ways) > 1) or \
+    (node_id == node_ways[0].nodes[0]) or (node_id == node_ways[0].nodes[-1])
 
-def dictWithXY(node, ways=None, add_original=False):
-    x,y,_,_ = from_latlon(node.lat, node.lon)
-    return {'ways':ways, 'x':x, 'y':y, 'lat':radians(node.lat), 'lon':radians(node.lon),
-            'original':node if add_original else None}
-
-if first_read:
-    spots = {nd.id:dictWithXY(nd, add_original=True) for nd in spots}
-    
-    for ww in ways:
-        for nd_id in ww.nodes:
-            nd = nodes[nd_id]
-            # If node found -> making a dict of data
-            if isinstance(nd, osm.Node):
-                nodes[nd_id] = dictWithXY(nd, ways=[ww])
-            else:
-                nd['ways'].append(ww)
+DIR_COUNT = {'no':2, 'yes':1, '-1':-1}
 
-    # Removing redundant nodes
-    nodes = {nd_id:nd for nd_id, nd in nodes.items() if isinstance(nd, dict)}
-    nodes.update(spots)
 
-if DEBUG:        
-    print('Nodes associated with roads:', len(nodes))
-    
-    print('Kinds of road in the file:')
-    types_rank = Counter(ww.tags['highway'] for ww in ways)
-    for kind, count in types_rank.most_common(15):
-        print('{:5} {}'.format(count, kind))
+class RoadGraph(object):
+    '''
+    `nodes` is a NodeStore of the road nodes and the spots, `ways` a list of
+    roads (parts of a clipped way share its id), `spots` { id: node dict },
+    `relations` the turn restriction relations. `useful_nodes` are the
+    vertices of the graph: crossings and road ends; `adj_list` maps them to
+    the sets of the next ones, `restrictions` is a TurnRestrictions.
+    `area` is the clip area or None.
+    `useful_nodes` with `nodes.ways`, `adj_list` and `restrictions` are
+    derived from the rest; a cache entry has them, else they are built.
+    '''
 
+    def __init__(self, source, nodes, ways, spots, relations, adj_list=None, useful_nodes=None,
+                 restrictions=None, area=None, is_spot=is_spot, verbose=False):
+        self.source, self.area, self.is_spot, self.verbose = source, area, is_spot, verbose
+        self.nodes, self.ways, self.spots, self.relations = nodes, ways, spots, relations
 
-is_useful = lambda node_id, node: node.get('ways') and ((len(node['ways']) > 1) or \
-    (node_id == node['ways'][0].nodes[0]) or (node_id == node['ways'][0].nodes[-1]))
+        if useful_nodes is None:
+            # Spots are not linked with roads, the extract may cut a way
+            road_nodes = set(nodes.ids.tolist()) - spots.keys()
+            for ww in ways:
+                for nd_id in ww.nodes:
+                    if nd_id in road_nodes:
+                        nodes.ways.setdefault(nd_id, []).append(ww)
+            del road_nodes
+            useful_nodes = {nd_tuple[0] for nd_tuple in nodes.ways.items() if is_useful(*nd_tuple)}
+        self.useful_nodes = useful_nodes
+        if verbose:
+            print('Important nodes number is {} out of {}'.format(len(self.useful_nodes), len(nodes)))
 
-useful_nodes = {nd_tuple[0] for nd_tuple in nodes.items() if is_useful(*nd_tuple)}
-if DEBUG:
-    print('Important nodes number is {} out of {}'.format(len(useful_nodes), len(nodes)))
+        if adj_list is None:
+            adj_list = defaultdict(set)
+            for ww in ways:
+                for nd1, nd2 in self.way_edges(ww):
+                    adj_list[nd1].add(nd2)
+        elif type(adj_list) is dict:
+            adj_list = defaultdict(set, adj_list)
+        self.adj_list = adj_list
 
-if first_read:
-    DIR_COUNT = {'no':2, 'yes':1, '-1':-1}
-    adj_list = defaultdict(set)
+        if restrictions is None:
+            restrictions = build_restrictions(relations, ways, self.adj_list, self.useful_nodes)
+        self.restrictions = restrictions
+        if verbose:
+            print('Turn restrictions: {} turns at {} nodes'.format(
+                len(self.restrictions), len(self.restrictions.vias)))
 
-    for ww in ways:
-        way_dirs = DIR_COUNT[ww.tags.get('oneway', 'no')]    
-        for nd1, nd2 in pairwise(filter(lambda nd: nd in useful_nodes, ww.nodes[::1 if way_dirs > 0 else -1])):
-            adj_list[nd1].add(nd2)
+    @property
+    def bbox(self):
+        "Bounding box of the clip area or None"
+        return getattr(self.area, 'bbox', self.area)
+
+    def way_edges(self, ww):
+        "Edges of the road graph along `ww`: pairs of its consecutive useful nodes"
+        way_dirs = DIR_COUNT[ww.tags.get('oneway', 'no')]
+        for nd1, nd2 in pairwise(filter(lambda nd: nd in self.useful_nodes, ww.nodes[::1 if way_dirs > 0 else -1])):
+            yield nd1, nd2
             if way_dirs == 2:
-                adj_list[nd2].add(nd1)
+                yield nd2, nd1
+
+    def save(self, path, **meta):
+        "Writes the graph to the cache entry `path`"
+        from graph_cache import save_graph
+
+        save_graph(path, self.nodes, self.ways, self.spots, self.relations, self.adj_list,
+                   self.useful_nodes, self.restrictions, version=VERSION, source=self.source, **meta)
+
+    def _read_coords(self, changed, missing):
+        "{id: (lon, lat)} in degrees: from the changed nodes, the store or the source file"
+        import numpy as np
+
+        nodes = self.nodes
+        coords = {nd_id: (nd.lon, nd.lat) for nd_id, nd in changed.items() if nd}
+        stored = [nd_id for nd_id in missing if nd_id not in coords and nd_id in nodes]
+        if stored:
+            lat, lon = nodes.coords(stored)
+            coords.update(zip(stored, zip(np.degrees(lon).tolist(), np.degrees(lat).tolist())))
+
+        missing = {nd_id for nd_id in missing if nd_id not in coords}
+        if missing:
+            try:
+                for nd in osm.parse_file(self.source, types={osm.Node}, index=True, compact=True):
+                    if nd.id in missing:
+                        coords[nd.id] = (nd.lon, nd.lat)
+            except FileNotFoundError:
+                print('Source file is not found, {} nodes are left out'.format(len(missing)))
+        return coords
+
+    def apply_changes(self, filename):
+        """
+        Applies an osmChange (.osc) file to `nodes`, `ways`, `spots` and
+        `adj_list` in place. Only the roads touched by the changes are processed
+        again; nodes that roads start using are looked up in the source file
+        if the change file doesn't have them. Turn restrictions are rebuilt.
+        """
+        import numpy as np
+        from utm import from_latlon
+
+        # the ways of a cache entry are a lazy sequence, the list is replaced below
+        self.ways = list(self.ways)
+        nodes, ways, spots, area = self.nodes, self.ways, self.spots, self.area
+        adj_list, useful_nodes, relations = self.adj_list, self.useful_nodes, self.relations
+
+        node_changes, way_changes, relation_changes = {}, {}, {}
+        for action, ent in osm.parse_file(filename, compact=True):
+            if isinstance(ent, osm.CompactNode):
+                node_changes[ent.id] = None if action == 'delete' else ent
+            elif isinstance(ent, osm.CompactWay):
+                way_changes[ent.id] = None if action == 'delete' or 'highway' not in ent.tags else ent
+            else:
+                relation_changes[ent.id] = None if action == 'delete' or 'restriction' not in ent.tags else ent
+
+        # Spots that appear or disappear
+        new_spots = {nd_id: nd for nd_id, nd in node_changes.items() if nd and self.is_spot(nd)
+                     and (area is None or area.contains(nd.lon, nd.lat))}
+        gone_spots = {nd_id for nd_id in node_changes if nd_id in spots and nd_id not in new_spots}
+        spot_ids = (spots.keys() - gone_spots) | new_spots.keys()
+
+        old_parts = [ww for ww in ways if ww.id in way_changes]
+        new_ways = [ww for ww in way_changes.values() if ww]
+        coords = self._read_coords(node_changes, {nd_id for ww in new_ways for nd_id in ww.nodes})
+        inside = {nd_id for nd_id, (lon, lat) in coords.items()
+                  if area is None or area.contains(lon, lat)}
+        new_parts = [part for ww in new_ways for part in split_way(ww, inside)]
+
+        # Ways through the touched nodes have to be linked again
+        touched = {nd_id for ww in old_parts + new_parts for nd_id in ww.nodes}
+        touched |= {nd_id for nd_id in node_changes if nd_id in nodes} | gone_spots | new_spots.keys()
+        dirty = {id(ww): ww for nd_id in touched for ww in nodes.ways.get(nd_id, ())}
+        # Spots are kept apart from the roads, so the roads through former spots
+        # are found by a scan
+        dirty.update((id(ww), ww) for ww in ways if any(nd_id in ww.nodes for nd_id in gone_spots))
+
+        ends = set()
+        for ww in dirty.values():
+            for nd1, nd2 in self.way_edges(ww):
+                adj_list[nd1].discard(nd2)
+                ends.update((nd1, nd2))
+
+        old_ids = {id(ww) for ww in old_parts}
+        ways[:] = [ww for ww in ways if id(ww) not in old_ids] + new_parts
+        for ww in old_parts:
+            for nd_id in ww.nodes:
+                node_ways = [w for w in nodes.ways.get(nd_id, ()) if id(w) not in old_ids]
+                if node_ways:
+                    nodes.ways[nd_id] = node_ways
+                else:
+                    nodes.ways.pop(nd_id, None)
+        for nd_id in gone_spots | new_spots.keys():
+            nodes.ways.pop(nd_id, None)
+        for ww in new_parts:
+            for nd_id in ww.nodes:
+                if nd_id not in spot_ids:
+                    nodes.ways.setdefault(nd_id, []).append(ww)
+        for nd_id in gone_spots:
+            node_ways = [ww for ww in ways if nd_id in ww.nodes]
+            if node_ways:
+                nodes.ways[nd_id] = node_ways
+
+        # Coordinates of the nodes in use, dropping the ones that aren't
+        for nd_id in touched:
+            if nd_id not in nodes.ways and nd_id not in spot_ids and nd_id in nodes:
+                del nodes[nd_id]
+        update = sorted(nd_id for nd_id in touched if nd_id in coords and
+                        (nd_id in nodes.ways or nd_id in spot_ids))
+        if update:
+            lon, lat = (np.array(column) for column in zip(*map(coords.get, update)))
+            x, y, _, _ = from_latlon(lat, lon)
+            nodes.merge(update, np.radians(lat), np.radians(lon), x, y)
+
+        for nd_id in gone_spots:
+            del spots[nd_id]
+            nodes.original.pop(nd_id, None)
+        for nd_id, nd in new_spots.items():
+            nodes.original[nd_id] = nd
+            spots[nd_id] = nodes[nd_id]
+
+        for nd_id in touched:
+            if nd_id in nodes.ways and is_useful(nd_id, nodes.ways[nd_id]):
+                useful_nodes.add(nd_id)
+            else:
+                useful_nodes.discard(nd_id)
+
+        relink = dict(dirty)
+        relink.update((id(ww), ww) for ww in new_parts)
+        relink.update((id(ww), ww) for nd_id in ends for ww in nodes.ways.get(nd_id, ()))
+        for key, ww in relink.items():
+            if key in old_ids:
+                continue
+            for nd1, nd2 in self.way_edges(ww):
+                adj_list[nd1].add(nd2)
+        for nd_id in ends:
+            if nd_id in adj_list and not adj_list[nd_id]:
+                del adj_list[nd_id]
+
+        relations[:] = [rel for rel in relations if rel.id not in relation_changes] + \
+            [rel for rel in relation_changes.values() if rel]
+        self.restrictions = build_restrictions(relations, ways, adj_list, useful_nodes)
 
+        if self.verbose:
+            print('Applied {}: {} nodes, {} ways and {} relations changed, {} roads relinked'.format(
+                filename, len(node_changes), len(way_changes), len(relation_changes), len(relink)))
 
-    dump = {'adj_list':adj_list, 'nodes': nodes, 'spots':spots, 'ways': ways, 'dump_ver':VERSION}
-    with open(FILENAME+'dump', 'wb') as f:
-        pickle.dump(dump, file=f)
+    def __repr__(self):
+        return '<RoadGraph of {}: {} roads, {} nodes, {} spots>'.format(
+            self.source, len(self.ways), len(self.useful_nodes), len(self.spots))
+
+
+def read_file(filename, bbox=None, polygon=None, is_spot=is_spot, verbose=False):
+    '''
+    Reads the roads, their nodes, the spots and the turn restrictions of
+    `filename`: returns a NodeStore, lists of ways and relations and
+    { id: node dict } of the spots
+    '''
+    from node_store import NodeStore
+
+    ways, relations, nodes, spots = [], [], {}, []
+
+    # First pass: the roads with their turn restrictions and the set of
+    # nodes they reference
+    for ent in osm.parse_file(filename, types={osm.Way, osm.Relation},
+                              require_tags={osm.Way: {'highway'}, osm.Relation: {'restriction'}},
+                              compact=True, bbox=bbox, polygon=polygon):
+        if isinstance(ent, osm.CompactWay):
+            ways.append(ent)
+        else:
+            relations.append(ent)
+    road_nodes = {nd_id for ww in ways for nd_id in ww.nodes}
+
+    # Second pass: only those nodes and the spots. For .pbf the blob
+    # index lets the parser skip way and relation blocks
+    for ent in osm.parse_file(filename, types={osm.Node}, index=True,
+                              compact=True, bbox=bbox, polygon=polygon):
+        if is_spot(ent):
+            spots.append(ent)
+        if ent.id in road_nodes:
+            nodes[ent.id] = ent
+    del road_nodes
+
+    if verbose:
+        print('Done with reading. Total ways in file: {}. Total nodes: {}. Restrictions: {}'.format(
+            len(ways), len(nodes), len(relations)))
+
+    nodes.update((nd.id, nd) for nd in spots)
+    nodes = NodeStore.from_elements(nodes.values(), original={nd.id: nd for nd in spots})
+    spots = {nd.id: nodes[nd.id] for nd in spots}
+    return nodes, ways, spots, relations
+
+
+def build_graph(source=DEFAULT_FILENAME, bbox=None, polygon=None, is_spot=is_spot,
+                changes=(), cache=True, spot_key=None, verbose=False):
+    '''
+    Road graph of `source` (.osm or .pbf), clipped to `bbox` = (min_lon,
+    min_lat, max_lon, max_lat) or `polygon` = [(lon, lat), ...] if given,
+    with the nodes passing `is_spot` as spots and the osmChange files
+    `changes` applied. With `cache` the graph is kept in `<source>.cache/`
+    (see graph_cache) and taken from there while the inputs stay the same.
+    A filter other than the default one is told apart in the cache by
+    `spot_key` (its repr, e.g. the tags it looks for); without it such
+    graphs are not cached, as two filters with the same code may differ in
+    what they close over.
+    '''
+    changes, area = list(changes), make_area(bbox, polygon)
+    graph = base_cache = changes_cache = None
+    if cache and spot_key is None and is_spot is not _default_is_spot:
+        if verbose:
+            print('No spot_key for the spot filter, the graph is not cached')
+        cache = False
+    if cache:
+        from graph_cache import CACHE_SUFFIX, cache_key, entry_path, load_graph
+
+        # Everything the graph depends on besides the input files. The
+        # default spot filter is keyed by its code, so editing it
+        # invalidates the cache
+        if spot_key is None:
+            spot_key = (is_spot.__code__.co_code, is_spot.__code__.co_consts,
+                        is_spot.__code__.co_names)
+        settings = (VERSION, bbox, polygon, spot_key)
+        directory = source + CACHE_SUFFIX
+        base_cache = entry_path(source, cache_key([source], settings, directory))
+        changes_cache = entry_path(source, cache_key([source] + changes, settings, directory)) \
+            if changes else base_cache
+
+        # Attempting to get 1 - cached graph (with the changes applied),
+        # 2 - cached graph of the file alone, 3 - the file itself
+        cached = load_graph(changes_cache)
+        if cached is not None:
+            changes = []
+        elif changes:
+            cached = load_graph(base_cache)
+        if cached is not None:
+            if verbose:
+                print('Found the graph in cache')
+            graph = RoadGraph(source, area=area, is_spot=is_spot, verbose=verbose, **cached)
+
+    if graph is None:
+        graph = RoadGraph(source, *read_file(source, bbox, polygon, is_spot, verbose),
+                          area=area, is_spot=is_spot, verbose=verbose)
+        if cache:
+            graph.save(base_cache, changes=[], bbox=bbox, polygon=polygon)
+
+    for filename in changes:
+        graph.apply_changes(filename)
+    if changes and cache:
+        graph.save(changes_cache, changes=changes, bbox=bbox, polygon=polygon)
+    return graph
+
+
+if __name__ == "__main__":
+    from sys import argv, exit
+
+    from output_mgr import build_map, set_bounds, write_adj_list
+
+    GUI = True
+    # Area of interest, None to keep the whole file:
+    # BBOX = (min_lon, min_lat, max_lon, max_lat), POLYGON = [(lon, lat), ...]
+    BBOX = None
+    POLYGON = None
+
+    # Attempting to get filename from 1 - ARGV, 2 - default name, 3 - GUI, 4 - STDIN
+    FILENAME = next((arg for arg in argv[1:] if arg.endswith(('.osm', '.pbf'))), None)
+    CHANGES = [arg for arg in argv[1:] if arg.endswith(('.osc', '.osc.gz', '.osc.bz2'))]
+    if not FILENAME:
+        FILENAME = DEFAULT_FILENAME
+        if GUI and not os.path.exists(FILENAME):
+            import dialog as dd
+            try:
+                FILENAME = dd.reqestFile()
+                if not FILENAME: # ↓ also critical
+                    FILENAME = input('Absolute path to the file or just name: ')
+            except:
+                print('GUI loading failed. Looking for ".osm" file.')
+                FILENAME = DEFAULT_FILENAME
+    if not os.path.exists(FILENAME):
+        exit('This program just need the file :(')
+
+    graph = build_graph(FILENAME, BBOX, POLYGON, changes=CHANGES, verbose=True)
+    if graph.bbox is not None:
+        set_bounds(right=graph.bbox.max_lon, top=graph.bbox.max_lat,
+                   left=graph.bbox.min_lon, bottom=graph.bbox.min_lat)
+
+    print('Nodes associated with roads:', len(graph.nodes))
+
+    print('Kinds of road in the file:')
+    types_rank = Counter(ww.tags['highway'] for ww in graph.ways)
+    for kind, count in types_rank.most_common(15):
+        print('{:5} {}'.format(count, kind))
 
-if DEBUG:
     options = ['light-map', 'full-map', 'adj-list']
     if GUI:
         chosen = options # options TODO: make this selectable
@@ -132,10 +384,10 @@ if DEBUG:
 
     if 'adj-list' in chosen:
         print('Creating an adjancety list...')
-        write_adj_list(adj_list, 'adj_list.txt')
-    if 'light-map' in chosen:    
+        write_adj_list(graph.adj_list, 'adj_list.txt')
+    if 'light-map' in chosen:
         print('Creating a light version of the map...')
-        build_map(nodes, ways, 'light_map.pdf', full=False)
+        build_map(graph.nodes, graph.ways, 'light_map.pdf', full=False)
     if 'full-map' in chosen:
         print('Creating a full map...')
-        build_map(nodes, ways, 'full_map.pdf')
+        build_map(graph.nodes, graph.ways, 'full_map.pdf')
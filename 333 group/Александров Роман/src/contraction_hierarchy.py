@@ -0,0 +1,362 @@
+'''
+Contraction hierarchies over the weighted road graph of
+`shortest_path.calculate_dists` (as a dict or a CSRGraph).
+
+Preprocessing contracts the nodes one by one, least important first (by
+edge difference and the number of contracted neighbors), adding a shortcut
+u -> x for u -> v -> x whenever a bounded local search finds no other path
+as short. A query is then a bidirectional Dijkstra that only goes up the
+order and settles a few hundred nodes instead of the whole city; shortcuts
+are unpacked back into road nodes, so the result is the usual
+Path(cost, path).
+
+Turn restrictions are built into the hierarchy: it is made over the search
+states, a via node having a state per previous node (see
+pathfinding_algorithms), so a hierarchy answers for the restrictions it was
+built with. `load_or_build` keeps hierarchies on disk by a digest of the
+graph and the restrictions, so each version of the graph is contracted once.
+'''
+from hashlib import blake2b
+from heapq import heappop, heappush
+from math import inf
+import os
+import tempfile
+
+import numpy as np
+
+from csr_graph import CSRGraph
+from pathfinding_algorithms import Path
+
+SUFFIX = '.ch.npz'
+# Hierarchies kept per directory, the most recently used ones
+KEEP = 4
+# Nodes a witness search may settle before giving up (and adding the shortcut)
+WITNESS_SETTLED = 500
+
+
+def graph_digest(gr, restrictions=None):
+    "Hash of the CSRGraph `gr` and of the TurnRestrictions `restrictions`"
+    digest = blake2b(gr.digest().encode(), digest_size=16)
+    if restrictions:
+        digest.update(repr(sorted((repr(turn), sorted(nexts)) for turn, nexts in
+                                  restrictions.forbidden.items())).encode())
+    return digest.hexdigest()
+
+
+def _state_graph(gr, restrictions):
+    '''
+    Edges { target: (cost, -1) } of every search state of CSRGraph `gr`.
+    State i < n is node i (entered from nowhere if it's a via node), states
+    from n on are the (via node, previous node) pairs. Returns the out
+    edges and the node of each state.
+    '''
+    n = len(gr)
+    indptr, indices, weights, _ = gr.views()
+    local = gr.local_restrictions(restrictions) if restrictions else None
+    vias = local.vias if local else ()
+
+    state_node, state_prev, extra = list(range(n)), [None] * n, {}
+    for u in range(n):
+        for k in range(indptr[u], indptr[u+1]):
+            if indices[k] in vias and (indices[k], u) not in extra:
+                extra[indices[k], u] = len(state_node)
+                state_node.append(indices[k])
+                state_prev.append(u)
+
+    out = [{} for _ in state_node]
+    for s, u in enumerate(state_node):
+        banned = local.banned(state_prev[s], u) if u in vias else ()
+        for k in range(indptr[u], indptr[u+1]):
+            v, c = indices[k], weights[k]
+            if v == u or v in banned:
+                continue
+            t = extra[v, u] if v in vias else v
+            if c < out[s].get(t, (inf,))[0]:
+                out[s][t] = (c, -1)
+    return out, state_node
+
+
+def _witness_dists(out, source, skip, limit, targets):
+    '''
+    Costs of the paths from `source` found without `skip`, not looking past
+    `limit` or after all of `targets` are settled
+    '''
+    dist, q, settled, left = {source: 0}, [(0, source)], 0, len(targets)
+    while q and settled < WITNESS_SETTLED and left:
+        cost, u = heappop(q)
+        if cost > dist[u]:
+            continue
+        if cost > limit:
+            break
+        settled += 1
+        if u in targets:
+            left -= 1
+        for v, (c, _) in out[u].items():
+            if v != skip and cost + c < dist.get(v, inf):
+                dist[v] = cost + c
+                heappush(q, (cost + c, v))
+    return dist
+
+
+def _shortcuts(out, inn, v):
+    "[(u, x, cost), ...]: the shortcuts contracting `v` needs"
+    shortcuts = []
+    if not out[v]:
+        return shortcuts
+    longest = max(c for c, _ in out[v].values())
+    for u, (c_in, _) in inn[v].items():
+        dist = _witness_dists(out, u, v, c_in + longest, out[v].keys() - {u})
+        for x, (c_out, _) in out[v].items():
+            if x != u and dist.get(x, inf) > c_in + c_out:
+                shortcuts.append((u, x, c_in + c_out))
+    return shortcuts
+
+
+def _pack(rows, ids):
+    "CSRGraph over `ids` and the middle node array out of [[(v, cost, middle), ...], ...]"
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=indptr[1:])
+    flat = [edge for row in rows for edge in row]
+    return (CSRGraph(ids, indptr, [v for v, _, _ in flat], [c for _, c, _ in flat]),
+            np.array([mid for _, _, mid in flat], dtype=np.int32))
+
+
+class ContractionHierarchy(object):
+    '''
+    Contracted graph over the search states: `up` holds the edges s -> t
+    going up the order, `down` the edges t -> s coming down to s (stored at
+    s, reversed), `up_middle` and `down_middle` the state each shortcut
+    skips (-1 for road edges). `ids` are the node ids, `state_node` the
+    node index of each state.
+    '''
+
+    def __init__(self, ids, state_node, up, up_middle, down, down_middle):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.state_node = np.asarray(state_node, dtype=np.int32)
+        self.up, self.down = up, down
+        self.up_middle = np.asarray(up_middle, dtype=np.int32)
+        self.down_middle = np.asarray(down_middle, dtype=np.int32)
+        if len(self.up) != len(self.state_node) or len(self.down) != len(self.state_node) \
+                or len(self.up_middle) != len(self.up.indices) \
+                or len(self.down_middle) != len(self.down.indices):
+            raise ValueError('Inconsistent hierarchy arrays')
+        # the states other than the node itself, by node
+        self._states = {}
+        for s, v in enumerate(self.state_node[len(self.ids):].tolist(), len(self.ids)):
+            self._states.setdefault(v, []).append(s)
+
+    @classmethod
+    def build(cls, gr, restrictions=None, verbose=False):
+        '''
+        Contracts `gr`, a dict { u: [(v, cost), ...] } or a CSRGraph, with
+        the TurnRestrictions `restrictions`
+        '''
+        if not hasattr(gr, 'indptr'):
+            gr = CSRGraph.from_dists(gr)
+        out, state_node = _state_graph(gr, restrictions)
+        inn = [{} for _ in out]
+        for s, edges in enumerate(out):
+            for t, edge in edges.items():
+                inn[t][s] = edge
+
+        # contracted neighbors and the depth of the hierarchy under each state
+        contracted, depth = [0] * len(out), [0] * len(out)
+        priority = lambda v, shortcuts: \
+            2 * len(shortcuts) - len(out[v]) - len(inn[v]) + contracted[v] + depth[v]
+        q = [(priority(v, _shortcuts(out, inn, v)), v) for v in range(len(out))]
+        q.sort()
+        up, down = [None] * len(out), [None] * len(out)
+        added = 0
+
+        while q:
+            _, v = heappop(q)
+            shortcuts = _shortcuts(out, inn, v)
+            # lazy update: contract only if it is still the least important
+            if q and priority(v, shortcuts) > q[0][0]:
+                heappush(q, (priority(v, shortcuts), v))
+                continue
+            for u, x, c in shortcuts:
+                if c < out[u].get(x, (inf,))[0]:
+                    out[u][x] = inn[x][u] = (c, v)
+            added += len(shortcuts)
+
+            up[v] = [(x, c, mid) for x, (c, mid) in out[v].items()]
+            down[v] = [(u, c, mid) for u, (c, mid) in inn[v].items()]
+            for u in inn[v]:
+                del out[u][v]
+                contracted[u] += 1
+                depth[u] = max(depth[u], depth[v] + 1)
+            for x in out[v]:
+                del inn[x][v]
+                contracted[x] += 1
+                depth[x] = max(depth[x], depth[v] + 1)
+            out[v] = inn[v] = None
+
+        if verbose:
+            print('Contracted {} states, {} shortcuts'.format(len(up), added))
+        states = np.arange(len(state_node))
+        return cls(gr.ids, state_node, *_pack(up, states), *_pack(down, states))
+
+    def save(self, filename):
+        "Writes the hierarchy to `filename` (replaced at once)"
+        directory = os.path.dirname(filename) or '.'
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=self.ids, state_node=self.state_node,
+                         up_indptr=self.up.indptr, up_indices=self.up.indices,
+                         up_weights=self.up.weights, up_middle=self.up_middle,
+                         down_indptr=self.down.indptr, down_indices=self.down.indices,
+                         down_weights=self.down.weights, down_middle=self.down_middle)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            states = np.arange(len(data['state_node']))
+            graphs = [CSRGraph(states, *(data[side + name] for name in ('_indptr', '_indices', '_weights')))
+                      for side in ('up', 'down')]
+            return cls(data['ids'], data['state_node'],
+                       graphs[0], data['up_middle'], graphs[1], data['down_middle'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.up.nbytes + self.down.nbytes + sum(
+            a.nbytes for a in (self.ids, self.state_node, self.up_middle, self.down_middle))
+
+    def _find(self, nd_id):
+        i = int(np.searchsorted(self.ids, nd_id))
+        return i if i < len(self.ids) and self.ids[i] == nd_id else None
+
+    def query(self, start, end):
+        '''
+        Shortest path from node `start` to node `end`: Path(cost, path) like
+        pathfinding_algorithms.astar, Path(inf, None) if there is none
+        '''
+        s, t = self._find(start), self._find(end)
+        if start == end:
+            return Path(0, (start,))
+        if s is None or t is None:
+            return Path(inf, None)
+
+        graphs = (self.up.views(), self.down.views())
+        dist, prev = ({s: 0}, {}), ({}, {})
+        q = ([(0, s)], [])
+        for target in [t] + self._states.get(t, []):
+            dist[1][target] = 0
+            q[1].append((0, target))
+        done = [False, False]
+        best, meet = inf, None
+
+        while not all(done):
+            for side in (0, 1):
+                if done[side]:
+                    continue
+                if not q[side] or q[side][0][0] >= best:
+                    done[side] = True
+                    continue
+                cost, u = heappop(q[side])
+                if cost > dist[side][u]:
+                    continue
+                if u in dist[1 - side] and cost + dist[1 - side][u] < best:
+                    best, meet = cost + dist[1 - side][u], u
+                indptr, indices, weights, _ = graphs[side]
+                for k in range(indptr[u], indptr[u+1]):
+                    v, c = indices[k], weights[k]
+                    if cost + c < dist[side].get(v, inf):
+                        dist[side][v], prev[side][v] = cost + c, (u, k)
+                        heappush(q[side], (cost + c, v))
+
+        if meet is None:
+            return Path(inf, None)
+        # road edges and shortcuts from `s` to `meet` and on to a state of `t`
+        edges = []
+        v = meet
+        while v in prev[0]:
+            u, k = prev[0][v]
+            edges.append((u, v, int(self.up_middle[k])))
+            v = u
+        edges.reverse()
+        v = meet
+        while v in prev[1]:
+            u, k = prev[1][v]
+            edges.append((v, u, int(self.down_middle[k])))
+            v = u
+        return Path(best, tuple(self.ids[self._unpack(s, edges)].tolist()))
+
+    def _middle(self, graph, middle, row, v):
+        "Middle state of the edge to (or from) `v` in `row` of `graph`"
+        indptr, indices = graph.indptr, graph.indices
+        for k in range(indptr[row], indptr[row + 1]):
+            if indices[k] == v:
+                return int(middle[k])
+        raise KeyError((row, v))
+
+    def _unpack(self, s, edges):
+        "Node indices along `edges` from `s`, shortcuts expanded"
+        states = [s]
+        stack = list(reversed(edges))
+        while stack:
+            a, b, mid = stack.pop()
+            if mid == -1:
+                states.append(b)
+                continue
+            # a -> mid comes down to mid, mid -> b goes up from it
+            stack.append((mid, b, self._middle(self.up, self.up_middle, mid, b)))
+            stack.append((a, mid, self._middle(self.down, self.down_middle, mid, a)))
+        return self.state_node[states]
+
+    def __repr__(self):
+        return '<ContractionHierarchy of {} nodes, {} states, {} edges>'.format(
+            len(self), len(self.state_node), len(self.up.indices) + len(self.down.indices))
+
+
+def load_or_build(gr, restrictions=None, directory=None, verbose=False):
+    '''
+    The hierarchy of `gr` with `restrictions`, taken from `directory` if it
+    has been built before, else built (and stored there if `directory` is
+    given). The KEEP most recently used hierarchies stay in `directory`.
+    '''
+    if not hasattr(gr, 'indptr'):
+        gr = CSRGraph.from_dists(gr)
+    if directory is None:
+        return ContractionHierarchy.build(gr, restrictions, verbose)
+
+    filename = os.path.join(directory, graph_digest(gr, restrictions) + SUFFIX)
+    if os.path.isfile(filename):
+        os.utime(filename)  # marks it as used for pruning
+        if verbose:
+            print('Found the hierarchy in', directory)
+        return ContractionHierarchy.load(filename)
+
+    hierarchy = ContractionHierarchy.build(gr, restrictions, verbose)
+    os.makedirs(directory, exist_ok=True)
+    hierarchy.save(filename)
+    _prune(directory)
+    return hierarchy
+
+
+def _prune(directory):
+    "Removes all but the KEEP most recently used hierarchies"
+    files = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(SUFFIX)]
+    files.sort(key=os.path.getmtime, reverse=True)
+    for filename in files[KEEP:]:
+        os.remove(filename)
+
+
+# The hierarchy pathfinding_algorithms.ch_search uses: (graph, restrictions, hierarchy)
+_current = (None, None, None)
+
+
+def use_hierarchy(gr, restrictions=None, directory=None, verbose=False):
+    "The hierarchy of `gr` and `restrictions`, kept for the last ones given"
+    global _current
+    if _current[0] is not gr or _current[1] is not restrictions:
+        _current = (gr, restrictions, load_or_build(gr, restrictions, directory, verbose))
+    return _current[2]
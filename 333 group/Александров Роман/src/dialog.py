@@ -6,7 +6,7 @@ app_window = tk.Tk()
 txt_box = tk.Label(app_window, text='''1. Open an .osm file
 2. Wait ~ 1 minute (while program looks frozen)
 3. Program produces a few files including:
- - ******.osmdump
+ - ******.osm.cache/
  - output/adj_list.txt
  - output/light_map.pdf
  - output/full_map.pdf
@@ -0,0 +1,340 @@
+'''
+On-disk cache of the road graph built by OSM_Processing.
+
+Entries live in `<source>.cache/<key>/`, where the key is a hash of the
+contents of the source file, the applied change files and the settings the
+graph was built with, so a changed input never hits a stale entry. The
+digests of the files are kept in `<source>.cache/digests.json` with their
+size and mtime, and a file is only read through again when those change.
+
+Arrays are kept as .npy files and memory-mapped on load; the few things that
+aren't arrays (way tags, spots, relations) go to JSON. Along with the ways
+and the adjacency an entry keeps what the graph derives from them (the
+useful nodes, the ways of each node, the forbidden turns), so loading
+doesn't compute them again. Ways, adjacency and the ways of the nodes are
+kept as offsets/values arrays and turned into objects as they are accessed.
+An entry is written to a temporary directory and renamed into place, so it
+is either complete or absent.
+'''
+from collections.abc import MutableMapping, Sequence
+from hashlib import blake2b
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import osmread as osm
+from osmread.elements import RelationMember
+
+from node_store import NodeStore
+from turn_restrictions import TurnRestrictions
+
+CACHE_SUFFIX = '.cache'
+# Entries kept per source file, the most recently used ones
+KEEP = 4
+# Digests of the input files with their size and mtime, in the cache directory
+DIGESTS = 'digests.json'
+
+_MEMBER_TYPES = {osm.Node: 'node', osm.Way: 'way', osm.Relation: 'relation'}
+_MEMBER_CLASSES = {name: cls for cls, name in _MEMBER_TYPES.items()}
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    digest = blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_digests(directory):
+    try:
+        with open(os.path.join(directory, DIGESTS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_digests(directory, digests):
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(digests, f)
+        os.replace(tmp, os.path.join(directory, DIGESTS))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def cache_key(filenames, settings, directory=None):
+    '''
+    Hash of the contents of `filenames` (in order) and of `repr(settings)`.
+    With `directory` the digests of the files are taken from there while
+    their size and mtime stay the same.
+    '''
+    known = _read_digests(directory) if directory else {}
+    changed = False
+    digest = blake2b(digest_size=16)
+    for filename in filenames:
+        st = os.stat(filename)
+        stamp, path = [st.st_size, st.st_mtime_ns], os.path.abspath(filename)
+        if known.get(path, [None])[:2] != stamp:
+            known[path] = stamp + [file_digest(filename)]
+            changed = True
+        digest.update(known[path][2].encode())
+    digest.update(repr(settings).encode())
+    if directory and changed:
+        _write_digests(directory, known)
+    return digest.hexdigest()
+
+
+def entry_path(source, key):
+    return os.path.join(source + CACHE_SUFFIX, key)
+
+
+def _pack(keys, values):
+    "Sorted int64 `keys`, offsets and the concatenated `values(key)` of each"
+    keys = np.array(sorted(keys), dtype=np.int64)
+    rows = [values(key) for key in keys.tolist()]
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    return keys, offsets, np.fromiter((v for row in rows for v in row), np.int64, int(offsets[-1]))
+
+
+def _pack_ways(ways):
+    lengths = np.fromiter((len(ww.nodes) for ww in ways), np.int64, len(ways))
+    offsets = np.zeros(len(ways) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    refs = np.fromiter((nd for ww in ways for nd in ww.nodes), np.int64, int(offsets[-1]))
+    ids = np.fromiter((ww.id for ww in ways), np.int64, len(ways))
+    return ids, offsets, refs
+
+
+def _pack_node_ways(node_ways, ways):
+    "The ways of each node as indices in `ways`"
+    index = {id(ww): i for i, ww in enumerate(ways)}
+    return _pack((nd for nd, nd_ways in node_ways.items() if nd_ways),
+                 lambda nd: [index[id(ww)] for ww in node_ways[nd]])
+
+
+def _pack_adj_list(adj_list):
+    return _pack((nd for nd, adj in adj_list.items() if adj), lambda nd: sorted(adj_list[nd]))
+
+
+def _pack_turns(restrictions):
+    "(prev, via) pairs and the nodes forbidden after each"
+    turns = sorted(restrictions.forbidden)
+    prevs = np.array([prev for prev, _ in turns], dtype=np.int64)
+    vias = np.array([via for _, via in turns], dtype=np.int64)
+    _, offsets, nexts = _pack(range(len(turns)), lambda i: sorted(restrictions.forbidden[turns[i]]))
+    return prevs, vias, offsets, nexts
+
+
+def _unpack_turns(prevs, vias, offsets, nexts):
+    nexts, offsets = nexts.tolist(), offsets.tolist()
+    return TurnRestrictions({turn: nexts[offsets[i]:offsets[i+1]]
+                             for i, turn in enumerate(zip(prevs.tolist(), vias.tolist()))})
+
+
+class LazyWays(Sequence):
+    '''
+    The ways of an entry over its arrays; a way is built on first access
+    and kept, as ways are told apart by identity
+    '''
+
+    def __init__(self, ids, offsets, refs, tags):
+        self._ids, self._offsets, self._refs, self._tags = ids, offsets, refs, tags
+        self._ways = [None] * len(ids)
+
+    def __len__(self):
+        return len(self._ways)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        ww = self._ways[i]
+        if ww is None:
+            i = range(len(self))[i]
+            begin, end = int(self._offsets[i]), int(self._offsets[i+1])
+            ww = self._ways[i] = osm.CompactWay(int(self._ids[i]), tags=self._tags[i],
+                                                nodes=self._refs[begin:end].tolist())
+        return ww
+
+
+class LazyMap(MutableMapping):
+    '''
+    { key: value } over sorted `keys`, `offsets` and `values` arrays of an
+    entry: a value is made by `make(values[offsets[i]:offsets[i+1]])` on
+    first access and kept; changes are kept in memory.
+    '''
+
+    def __init__(self, keys, offsets, values, make):
+        self._keys, self._offsets, self._values, self._make = keys, offsets, values, make
+        # made or set values, deleted keys of the arrays, keys set besides them
+        self._made, self._removed, self._added = {}, set(), {}
+
+    def _find(self, key):
+        "Position of `key` in the arrays or None"
+        i = int(np.searchsorted(self._keys, key))
+        return i if i < len(self._keys) and self._keys[i] == key else None
+
+    def get(self, key, default=None):
+        if key in self._made:
+            return self._made[key]
+        i = self._find(key) if key not in self._removed else None
+        if i is None:
+            return default
+        value = self._made[key] = self._make(self._values[self._offsets[i]:self._offsets[i+1]])
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._removed.discard(key)
+        if key not in self._made and self._find(key) is None:
+            self._added[key] = None
+        self._made[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._made.pop(key, None)
+        if key in self._added:
+            del self._added[key]
+        else:
+            self._removed.add(key)
+
+    def __contains__(self, key):
+        return key in self._made or (key not in self._removed and self._find(key) is not None)
+
+    def __iter__(self):
+        removed = self._removed
+        for key in self._keys.tolist():
+            if key not in removed:
+                yield key
+        yield from list(self._added)
+
+    def __len__(self):
+        return len(self._keys) - len(self._removed) + len(self._added)
+
+
+class LazyAdjList(LazyMap):
+    "{ node: set of the next nodes } of an entry, a missing node gets an empty set as in defaultdict(set)"
+
+    def __init__(self, sources, offsets, targets):
+        super().__init__(sources, offsets, targets, lambda targets: set(targets.tolist()))
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            value = self[key] = set()
+        return value
+
+
+def _node_json(nd):
+    return {'id': nd.id, 'tags': dict(nd.tags), 'lon': nd.lon, 'lat': nd.lat}
+
+
+def _relation_json(rel):
+    return {'id': rel.id, 'tags': dict(rel.tags),
+            'members': [(m.role, _MEMBER_TYPES[m.type], m.member_id) for m in rel.members]}
+
+
+def _relation(data):
+    return osm.CompactRelation(data['id'], tags=data['tags'], members=(
+        RelationMember(role, _MEMBER_CLASSES[kind], ref) for role, kind, ref in data['members']))
+
+
+def save_graph(path, nodes, ways, spots, relations, adj_list, useful_nodes, restrictions, **meta):
+    '''
+    Writes an entry. `nodes` is a NodeStore without overlay points (its
+    `ways` filled), `spots` a dict of node dicts with the 'original' nodes,
+    `restrictions` a TurnRestrictions, `meta` goes to meta.json.
+    '''
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        sections = nodes.columns('node_')
+        for name, column in zip(('way_ids', 'way_offsets', 'way_refs'), _pack_ways(ways)):
+            sections[name] = column
+        for name, column in zip(('adj_sources', 'adj_offsets', 'adj_targets'), _pack_adj_list(adj_list)):
+            sections[name] = column
+        for name, column in zip(('node_way_nodes', 'node_way_offsets', 'node_way_indices'),
+                                _pack_node_ways(nodes.ways, ways)):
+            sections[name] = column
+        for name, column in zip(('turn_prevs', 'turn_vias', 'turn_offsets', 'turn_nexts'),
+                                _pack_turns(restrictions)):
+            sections[name] = column
+        sections['useful_nodes'] = np.array(sorted(useful_nodes), dtype=np.int64)
+        for name, column in sections.items():
+            np.save(os.path.join(tmp, name + '.npy'), column)
+
+        with open(os.path.join(tmp, 'objects.json'), 'w') as f:
+            json.dump({'way_tags': [dict(ww.tags) for ww in ways],
+                       'spots': [_node_json(spot['original']) for spot in spots.values()],
+                       'relations': [_relation_json(rel) for rel in relations]}, f)
+        # written last: an entry without it is not complete
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    _prune(parent)
+
+
+def load_graph(path):
+    '''
+    Reads an entry written by `save_graph`: returns a dict with `nodes`
+    (`ways` included), `ways`, `spots`, `relations`, `adj_list`,
+    `useful_nodes` and `restrictions`, or None if there is no complete entry
+    at `path`. Ways and the maps are lazy, see LazyWays and LazyMap.
+    '''
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+    os.utime(path)  # marks it as used for pruning
+
+    def section(name):
+        # copy-on-write: the store may be updated in memory, never on disk
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+
+    with open(os.path.join(path, 'objects.json')) as f:
+        objects = json.load(f)
+
+    spots = [osm.CompactNode(nd['id'], tags=nd['tags'], lon=nd['lon'], lat=nd['lat'])
+             for nd in objects['spots']]
+    ways = LazyWays(section('way_ids'), section('way_offsets'), section('way_refs'),
+                    objects['way_tags'])
+    nodes = NodeStore.from_columns(section, 'node_', original={nd.id: nd for nd in spots})
+    nodes.ways = LazyMap(section('node_way_nodes'), section('node_way_offsets'),
+                         section('node_way_indices'), lambda indices: [ways[i] for i in indices.tolist()])
+    return {
+        'nodes': nodes,
+        'ways': ways,
+        'spots': {nd.id: nodes[nd.id] for nd in spots},
+        'relations': [_relation(rel) for rel in objects['relations']],
+        'adj_list': LazyAdjList(section('adj_sources'), section('adj_offsets'),
+                                section('adj_targets')),
+        'useful_nodes': set(section('useful_nodes').tolist()),
+        'restrictions': _unpack_turns(section('turn_prevs'), section('turn_vias'),
+                                      section('turn_offsets'), section('turn_nexts')),
+    }
+
+
+def _prune(parent):
+    "Removes all but the KEEP most recently used entries"
+    entries = [os.path.join(parent, name) for name in os.listdir(parent)
+               if not name.startswith('.tmp-') and os.path.isdir(os.path.join(parent, name))]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[KEEP:]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,234 @@
+'''
+ALT (A*, landmarks, triangle inequality) heuristic.
+
+For a landmark L the triangle inequality gives two lower bounds of the
+road distance d(v, t): d(L, t) - d(L, v) and d(v, L) - d(t, L). Unlike the
+geometric heuristics they follow the roads, so a river with few bridges
+doesn't fool them. The tables are computed on the graph without turn
+restrictions: restrictions only make paths longer, so the bounds hold.
+
+`Landmarks` is a heuristic for pathfinding_algorithms.astar as it is:
+`astar(gr, start, end, heur=Landmarks.build(gr))`. `load_or_build` keeps
+the tables on disk by the digest of the graph, like contraction_hierarchy.
+'''
+from heapq import heappop, heappush
+from math import inf
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from csr_graph import CSRGraph
+
+SUFFIX = '.alt.npz'
+# Tables kept per directory, the most recently used ones
+KEEP = 4
+METHODS = ('avoid', 'farthest')
+
+
+def _tree(gr, sources):
+    '''
+    Distances from `sources` over CSRGraph `gr`, the parents in the
+    shortest path tree and the nodes in the order they were settled
+    '''
+    indptr, indices, weights, _ = gr.views()
+    dist, parent, order = [inf] * len(gr), [-1] * len(gr), []
+    q = []
+    for s in sources:
+        dist[s] = 0
+        q.append((0, s))
+    while q:
+        cost, u = heappop(q)
+        if cost > dist[u]:
+            continue
+        order.append(u)
+        for k in range(indptr[u], indptr[u+1]):
+            v = indices[k]
+            if cost + weights[k] < dist[v]:
+                dist[v], parent[v] = cost + weights[k], u
+                heappush(q, (cost + weights[k], v))
+    return np.array(dist), parent, order
+
+
+def _lower_bounds(dist_from, dist_to, r):
+    "Lower bounds of d(r, v) for all v by the landmarks found so far"
+    if not len(dist_from):
+        return np.zeros(dist_from.shape[1])
+    with np.errstate(invalid='ignore'):
+        bounds = np.maximum(dist_from - dist_from[:, [r]], dist_to[:, [r]] - dist_to)
+    return np.nan_to_num(bounds, nan=0, posinf=0, neginf=0).max(axis=0).clip(0)
+
+
+def _farthest(gr, nodes, dist_from, dist_to, rnd):
+    "Next landmark: the node farthest from the ones found so far (from a random node at first)"
+    dist, _, _ = _tree(gr, nodes or [rnd.randrange(len(gr))])
+    dist[np.isinf(dist)] = -1
+    return int(np.argmax(dist))
+
+
+def _avoid(gr, nodes, dist_from, dist_to, rnd):
+    '''
+    Next landmark by the "avoid" rule: in the shortest path tree of a
+    random root a node weighs as much as the current bounds underestimate
+    its distance from the root, subtrees with a landmark weigh nothing; the
+    landmark is the leaf reached going down the heaviest subtrees.
+    '''
+    r = rnd.randrange(len(gr))
+    dist, parent, order = _tree(gr, [r])
+    size = (dist - _lower_bounds(dist_from, dist_to, r)).tolist()
+    covered = set(nodes)
+    # children are settled after their parents
+    for v in reversed(order):
+        p = parent[v]
+        if v in covered:
+            size[v] = 0
+            covered.add(p)
+        elif p != -1:
+            size[p] += size[v]
+
+    heaviest = {}
+    for v in order[1:]:
+        p = parent[v]
+        if size[v] > 0 and (p not in heaviest or size[v] > size[heaviest[p]]):
+            heaviest[p] = v
+    v = r
+    while v in heaviest:
+        v = heaviest[v]
+    return v if v not in nodes else _farthest(gr, nodes, dist_from, dist_to, rnd)
+
+
+class Landmarks(object):
+    '''
+    Landmark tables over the nodes of a CSRGraph: `ids` are its node ids,
+    `nodes` the landmark indices, `dist_from[i, v]` is the road distance
+    from landmark i to node v and `dist_to[i, v]` from v to it (inf where
+    there is no path).
+    Calling it as `heur(nd_id, end)` gives the ALT lower bound of the
+    distance, 0 for the nodes it doesn't know.
+    '''
+
+    def __init__(self, ids, nodes, dist_from, dist_to):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+        self.dist_from = np.asarray(dist_from, dtype=np.float64)
+        self.dist_to = np.asarray(dist_to, dtype=np.float64)
+        if not self.dist_from.shape == self.dist_to.shape == (len(self.nodes), len(self.ids)):
+            raise ValueError('Inconsistent landmark tables')
+        self._pos = {nd_id: i for i, nd_id in enumerate(self.ids.tolist())}
+        # node-major copies: the bounds of a node are next to each other
+        self._rows = tuple(memoryview(np.ascontiguousarray(table.T).ravel())
+                           for table in (self.dist_from, self.dist_to))
+        self._target = (None, None)
+
+    @classmethod
+    def build(cls, gr, k=8, method='avoid', seed=0):
+        '''
+        Selects `k` landmarks of `gr` (a dict { u: [(v, cost), ...] } or a
+        CSRGraph) by `method` ('avoid' or 'farthest') and computes the tables
+        '''
+        if method not in METHODS:
+            raise ValueError('Unknown landmark selection method {!r}'.format(method))
+        if not hasattr(gr, 'indptr'):
+            gr = CSRGraph.from_dists(gr)
+        select = _avoid if method == 'avoid' else _farthest
+        rnd = random.Random(seed)
+        nodes, dist_from, dist_to = [], np.empty((0, len(gr))), np.empty((0, len(gr)))
+        for _ in range(min(k, len(gr))):
+            v = select(gr, nodes, dist_from, dist_to, rnd)
+            if v in nodes:
+                break
+            nodes.append(v)
+            dist_from = np.vstack((dist_from, _tree(gr, [v])[0]))
+            dist_to = np.vstack((dist_to, _tree(gr.reverse(), [v])[0]))
+        return cls(gr.ids, nodes, dist_from, dist_to)
+
+    def save(self, filename):
+        "Writes the tables to `filename` (replaced at once)"
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=self.ids, nodes=self.nodes,
+                         dist_from=self.dist_from, dist_to=self.dist_to)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['ids'], data['nodes'], data['dist_from'], data['dist_to'])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.ids, self.nodes, self.dist_from, self.dist_to))
+
+    def __call__(self, nd_id, end):
+        v = self._pos.get(nd_id)
+        if self._target[0] != end:
+            t = self._pos.get(end)
+            self._target = (end, None if t is None else
+                            (self.dist_from[:, t].tolist(), self.dist_to[:, t].tolist()))
+        if v is None or self._target[1] is None:
+            return 0
+        k = len(self.nodes)
+        from_t, to_t = self._target[1]
+        from_v, to_v = (rows[v*k:(v+1)*k] for rows in self._rows)
+        best = 0
+        # inf - inf is nan and never the best
+        for ft, fv, tv, tt in zip(from_t, from_v, to_v, to_t):
+            if ft - fv > best:
+                best = ft - fv
+            if tv - tt > best:
+                best = tv - tt
+        return best
+
+    def __repr__(self):
+        return '<Landmarks: {} over {} nodes>'.format(len(self), len(self.ids))
+
+
+def load_or_build(gr, k=8, method='avoid', directory=None):
+    '''
+    The landmarks of `gr`, taken from `directory` if they have been built
+    before, else built (and stored there if `directory` is given). The KEEP
+    most recently used tables stay in `directory`.
+    '''
+    if not hasattr(gr, 'indptr'):
+        gr = CSRGraph.from_dists(gr)
+    if directory is None:
+        return Landmarks.build(gr, k, method)
+
+    filename = os.path.join(directory, '{}-{}{}{}'.format(gr.digest(), method, k, SUFFIX))
+    if os.path.isfile(filename):
+        os.utime(filename)  # marks it as used for pruning
+        return Landmarks.load(filename)
+
+    landmarks = Landmarks.build(gr, k, method)
+    os.makedirs(directory, exist_ok=True)
+    landmarks.save(filename)
+    _prune(directory)
+    return landmarks
+
+
+def _prune(directory):
+    "Removes all but the KEEP most recently used tables"
+    files = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(SUFFIX)]
+    files.sort(key=os.path.getmtime, reverse=True)
+    for filename in files[KEEP:]:
+        os.remove(filename)
+
+
+# The landmarks pathfinding_algorithms.astar_alt uses: (graph, landmarks)
+_current = (None, None)
+
+
+def use_landmarks(gr, k=8, method='avoid', directory=None):
+    "The landmarks of `gr`, kept for the last graph given"
+    global _current
+    if _current[0] is not gr:
+        _current = (gr, load_or_build(gr, k, method, directory))
+    return _current[1]
@@ -28,6 +28,7 @@ def timed(fn):
     decfn.last_run = lambda: fn.hist[-1] if fn.hist else None
     decfn.avg = lambda: sum(fn.hist)/len(fn.hist) if fn.hist else None
     decfn.stats = lambda: _stats_string(fn.hist, fn.__name__)
+    decfn.reset = fn.hist.clear
     timed.funcs.add(decfn)
     return decfn
 
@@ -0,0 +1,211 @@
+from collections.abc import MutableMapping
+
+import numpy as np
+
+FIELDS = ('lat', 'lon', 'x', 'y')
+
+
+class NodeStore(MutableMapping):
+    '''
+    Node data kept column-wise: a sorted int64 array of ids and parallel
+    float64 arrays `lat`, `lon` (radians), `x`, `y` (UTM). `ways` and
+    `original` are dicts holding the few nodes that have them.
+    As a mapping it looks like the old { id: {'ways', 'x', 'y', 'lat', 'lon',
+    'original'} } dict; item dicts are built on access, so assigning to them
+    doesn't change the store. Keys that are not in the arrays (e.g. start
+    points of the demos) are kept as they are in an overlay dict.
+    Building an item dict is slow next to a dict lookup: code that looks
+    nodes up one by one takes `table()`, code over many nodes `coords()`.
+    '''
+
+    def __init__(self, ids, lat, lon, x, y, ways=None, original=None):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        if len(self.ids) > 1 and not (np.diff(self.ids) > 0).all():
+            raise ValueError('Duplicate node ids')
+        for name, column in zip(FIELDS, (lat, lon, x, y)):
+            setattr(self, name, np.asarray(column, dtype=np.float64)[order])
+
+        self.__init_maps(ways, original)
+
+    def __init_maps(self, ways, original):
+        self.ways = dict(ways or {})
+        self.original = dict(original or {})
+        self._removed = set()
+        self._extra = {}
+        # tables by fields, see `table`
+        self._tables = {}
+
+    @classmethod
+    def from_columns(cls, get, prefix='', ways=None, original=None):
+        '''
+        Builds a store over columns that are already sorted by id, e.g.
+        memory-mapped ones: `get(prefix + name)` returns the column `name`.
+        '''
+        store = cls.__new__(cls)
+        for name in ('ids',) + FIELDS:
+            setattr(store, name, get(prefix + name))
+        store.__init_maps(ways, original)
+        return store
+
+    def columns(self, prefix=''):
+        "The arrays as { prefix + name: column }, without the deleted ids"
+        keep = ~np.isin(self.ids, list(self._removed)) if self._removed else slice(None)
+        return {prefix + name: getattr(self, name)[keep] for name in ('ids',) + FIELDS}
+
+    @classmethod
+    def from_elements(cls, elements, ways=None, original=None):
+        "Builds a store from osmread nodes (lat/lon in degrees)"
+        from utm import from_latlon
+
+        elements = list(elements)
+        ids = np.fromiter((nd.id for nd in elements), np.int64, len(elements))
+        lat = np.fromiter((nd.lat for nd in elements), np.float64, len(elements))
+        lon = np.fromiter((nd.lon for nd in elements), np.float64, len(elements))
+        if elements:
+            x, y, _, _ = from_latlon(lat, lon)
+        else:
+            x = y = lat
+        return cls(ids, np.radians(lat), np.radians(lon), x, y, ways, original)
+
+    def index(self, ids):
+        '''
+        Vectorized id -> position in the arrays. Takes an id or a sequence of
+        them, raises KeyError if any of them isn't stored in the arrays.
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, ids)
+        if len(self.ids):
+            found = self.ids[np.minimum(pos, len(self.ids) - 1)] == ids
+        else:
+            found = np.zeros(ids.shape, dtype=bool)
+        if self._removed:
+            found &= ~np.isin(ids, list(self._removed))
+        if not found.all():
+            raise KeyError(np.atleast_1d(ids)[~np.atleast_1d(found)].tolist())
+        return pos
+
+    def coords(self, ids, fields=('lat', 'lon')):
+        '''
+        Columns `fields` for the given ids (overlay points included), e.g.
+        lat, lon = store.coords(ids)
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        extra = np.fromiter((key in self._extra for key in ids.ravel().tolist()), bool,
+                            ids.size).reshape(ids.shape) if self._extra else None
+        if extra is None or not extra.any():
+            pos = self.index(ids)
+            return tuple(getattr(self, name)[pos] for name in fields)
+
+        pos = self.index(ids[~extra])
+        columns = tuple(np.empty(ids.shape) for _ in fields)
+        for name, column in zip(fields, columns):
+            column[~extra] = getattr(self, name)[pos]
+            column[extra] = [self._extra[key][name] for key in ids[extra].tolist()]
+        return columns
+
+    def table(self, fields=('lat', 'lon')):
+        '''
+        { id: (values of `fields`) } of all the nodes, overlay points
+        included, for lookups one by one (heuristics, distances, drawing).
+        Built from the columns at once and kept up to date with the store.
+        '''
+        fields = tuple(fields)
+        table = self._tables.get(fields)
+        if table is None:
+            columns = self.columns()
+            table = dict(zip(columns['ids'].tolist(),
+                             zip(*(columns[name].tolist() for name in fields))))
+            table.update((key, tuple(value[name] for name in fields))
+                         for key, value in self._extra.items())
+            self._tables[fields] = table
+        return table
+
+    def merge(self, ids, lat, lon, x, y):
+        '''
+        Sets the columns of `ids` (in the units of the constructor), adding
+        the ones that aren't stored yet; their overlay entries are dropped.
+        Deleted ids are removed from the arrays on the way.
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        keep = ~np.isin(self.ids, ids)
+        if self._removed:
+            keep &= ~np.isin(self.ids, list(self._removed))
+        merged = NodeStore(np.concatenate((self.ids[keep], ids)),
+                           *(np.concatenate((getattr(self, name)[keep], column))
+                             for name, column in zip(FIELDS, (lat, lon, x, y))))
+        self.ids = merged.ids
+        for name in FIELDS:
+            setattr(self, name, getattr(merged, name))
+        self._removed.clear()
+        for key in ids.tolist():
+            self._extra.pop(key, None)
+        self._tables.clear()
+
+    def __find(self, key):
+        "Position of `key` in the arrays or None"
+        if key in self._removed or not isinstance(key, (int, np.integer)) \
+                or not len(self.ids):
+            return None
+        pos = int(np.searchsorted(self.ids, key))
+        if pos < len(self.ids) and self.ids[pos] == key:
+            return pos
+        return None
+
+    def __getitem__(self, key):
+        if key in self._extra:
+            return self._extra[key]
+        pos = self.__find(key)
+        if pos is None:
+            raise KeyError(key)
+        return {'ways': self.ways.get(key),
+                'x': float(self.x[pos]), 'y': float(self.y[pos]),
+                'lat': float(self.lat[pos]), 'lon': float(self.lon[pos]),
+                'original': self.original.get(key)}
+
+    def __setitem__(self, key, value):
+        self._removed.discard(key)
+        for fields, table in self._tables.items():
+            table[key] = tuple(value[name] for name in fields)
+        pos = self.__find(key)
+        if pos is None:
+            self._extra[key] = value
+            return
+        for name in FIELDS:
+            getattr(self, name)[pos] = value[name]
+        for name in ('ways', 'original'):
+            column = getattr(self, name)
+            if value.get(name) is None:
+                column.pop(key, None)
+            else:
+                column[key] = value[name]
+
+    def __delitem__(self, key):
+        for table in self._tables.values():
+            table.pop(key, None)
+        if key in self._extra:
+            del self._extra[key]
+        elif self.__find(key) is not None:
+            self._removed.add(key)
+            self.ways.pop(key, None)
+            self.original.pop(key, None)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._extra or self.__find(key) is not None
+
+    def __iter__(self):
+        removed = self._removed
+        for key in self.ids.tolist():
+            if key not in removed:
+                yield key
+        yield from self._extra
+
+    def __len__(self):
+        return len(self.ids) - len(self._removed) + len(self._extra)
+
+    def __repr__(self):
+        return '<NodeStore of {} nodes>'.format(len(self))
+
@@ -1,18 +1,32 @@
-from osmread.elements import Node, Way, Relation
+import os
+
+from osmread.parser.compression import SUFFIXES
+from osmread.elements import (
+    Node, Way, Relation, NodeBatch, WayBatch, RelationBatch,
+    CompactNode, CompactWay, CompactRelation, EMPTY_TAGS, Change
+)
 
 
 def parse_file(filename, **kwargs):
     parser_cls = None
     kwargs = dict(kwargs)
 
-    if filename.endswith(('.osm', '.xml', '.osm.bz2', '.xml.bz2')) \
-            or kwargs.get('format', None) == 'xml':
+    name, ext = os.path.splitext(filename)
+    compression = SUFFIXES.get(ext)
+    if compression is None:
+        name = filename
+
+    if name.endswith('.osc') or kwargs.get('format', None) == 'osc':
+        kwargs['changes'] = True
+
+    if name.endswith(('.osm', '.xml', '.osc')) \
+            or kwargs.get('format', None) in ('xml', 'osc'):
 
         from osmread.parser.xml import XmlParser
         parser_cls = XmlParser
 
-        if filename.endswith('.bz2'):
-            kwargs['compression'] = 'bz2'
+        if compression and not kwargs.get('compression'):
+            kwargs['compression'] = compression
 
     elif filename.endswith('.pbf') \
             or kwargs.get('format', None) == 'pbf':
@@ -0,0 +1,124 @@
+"""
+Columnar batch mode: turns streams of elements into `NodeBatch`, `WayBatch`
+and `RelationBatch` chunks. Requires NumPy.
+"""
+import numpy as np
+
+from osmread.elements import (
+    Node, Way, Relation, CompactNode, CompactWay, CompactRelation,
+    NodeBatch, WayBatch, RelationBatch, TYPE_NODE, TYPE_WAY, TYPE_RELATION,
+    intern
+)
+
+
+DEFAULT_BATCH_SIZE = 8000
+
+_MEMBER_TYPES = {Node: TYPE_NODE, Way: TYPE_WAY, Relation: TYPE_RELATION}
+
+
+def intern_tags(tags):
+    return dict((intern(k), intern(v)) for k, v in tags.items())
+
+
+class NodeBatchBuilder(object):
+
+    def __init__(self):
+        self.ids, self.lons, self.lats, self.tags = [], [], [], {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node):
+        if node.tags:
+            self.tags[len(self.ids)] = intern_tags(node.tags)
+        self.ids.append(node.id)
+        self.lons.append(node.lon)
+        self.lats.append(node.lat)
+
+    def build(self):
+        return NodeBatch(
+            ids=np.array(self.ids, dtype=np.int64),
+            lons=np.array(self.lons, dtype=np.float64),
+            lats=np.array(self.lats, dtype=np.float64),
+            tags=self.tags,
+        )
+
+
+class WayBatchBuilder(object):
+
+    def __init__(self):
+        self.ids, self.offsets, self.refs, self.tags = [], [0], [], {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, way):
+        if way.tags:
+            self.tags[len(self.ids)] = intern_tags(way.tags)
+        self.ids.append(way.id)
+        self.refs.extend(way.nodes)
+        self.offsets.append(len(self.refs))
+
+    def build(self):
+        return WayBatch(
+            ids=np.array(self.ids, dtype=np.int64),
+            offsets=np.array(self.offsets, dtype=np.int64),
+            refs=np.array(self.refs, dtype=np.int64),
+            tags=self.tags,
+        )
+
+
+class RelationBatchBuilder(object):
+
+    def __init__(self):
+        self.ids, self.offsets, self.tags = [], [0], {}
+        self.member_ids, self.member_types, self.member_roles = [], [], []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, relation):
+        if relation.tags:
+            self.tags[len(self.ids)] = intern_tags(relation.tags)
+        self.ids.append(relation.id)
+        for role, mtype, mid in relation.members:
+            self.member_roles.append(intern(role))
+            self.member_types.append(_MEMBER_TYPES[mtype])
+            self.member_ids.append(mid)
+        self.offsets.append(len(self.member_ids))
+
+    def build(self):
+        return RelationBatch(
+            ids=np.array(self.ids, dtype=np.int64),
+            offsets=np.array(self.offsets, dtype=np.int64),
+            member_ids=np.array(self.member_ids, dtype=np.int64),
+            member_types=np.array(self.member_types, dtype=np.int8),
+            member_roles=self.member_roles,
+            tags=self.tags,
+        )
+
+
+_BUILDERS = {
+    Node: NodeBatchBuilder,
+    Way: WayBatchBuilder,
+    Relation: RelationBatchBuilder,
+    CompactNode: NodeBatchBuilder,
+    CompactWay: WayBatchBuilder,
+    CompactRelation: RelationBatchBuilder,
+}
+
+
+def iter_batches(elements, batch_size=DEFAULT_BATCH_SIZE):
+    "Groups runs of elements of the same type into batches of `batch_size`"
+    builder = None
+
+    for e in elements:
+        builder_class = _BUILDERS[type(e)]
+        if type(builder) is not builder_class or len(builder) >= batch_size:
+            if builder:
+                yield builder.build()
+            builder = builder_class()
+        builder.add(e)
+
+    if builder:
+        yield builder.build()
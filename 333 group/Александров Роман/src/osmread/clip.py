@@ -0,0 +1,119 @@
+"""
+Clipping of the parsed elements to an area: a bounding box or a polygon.
+Pass `bbox=` or `polygon=` to `parse_file`.
+"""
+from collections import namedtuple
+
+from osmread.elements import Node, Way, Relation, ELEMENT_TYPES
+
+
+class BBox(namedtuple('BBox', ('min_lon', 'min_lat', 'max_lon', 'max_lat'))):
+
+    def contains(self, lon, lat):
+        return self.min_lon <= lon <= self.max_lon and \
+            self.min_lat <= lat <= self.max_lat
+
+
+class Polygon(object):
+    "Simple polygon given by its vertices as (lon, lat) pairs"
+
+    def __init__(self, points):
+        self.points = [(float(lon), float(lat)) for lon, lat in points]
+        if len(self.points) < 3:
+            raise ValueError('A polygon needs at least 3 points')
+        lons, lats = zip(*self.points)
+        self.bbox = BBox(min(lons), min(lats), max(lons), max(lats))
+        self._edges = list(zip(self.points, self.points[1:] + self.points[:1]))
+
+    def contains(self, lon, lat):
+        "Even-odd rule: the number of edges crossed by a ray going east"
+        if not self.bbox.contains(lon, lat):
+            return False
+        inside = False
+        for (lon1, lat1), (lon2, lat2) in self._edges:
+            if (lat1 > lat) != (lat2 > lat) and \
+                    lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+        return inside
+
+    def __repr__(self):
+        return 'Polygon(%r)' % (self.points,)
+
+
+def make_area(bbox=None, polygon=None):
+    "`bbox` is (min_lon, min_lat, max_lon, max_lat), `polygon` (lon, lat) pairs"
+    if bbox is not None and polygon is not None:
+        raise ValueError('Pass either bbox or polygon, not both')
+    if bbox is not None:
+        return bbox if isinstance(bbox, BBox) else BBox(*bbox)
+    if polygon is not None:
+        return polygon if isinstance(polygon, Polygon) else Polygon(polygon)
+    return None
+
+
+def split_way(way, inside):
+    """
+    Yields the parts of `way` made of consecutive nodes from `inside`, as
+    elements of the same class and id. Parts of a single node are dropped.
+    """
+    run = []
+    for nd_id in way.nodes:
+        if nd_id in inside:
+            run.append(nd_id)
+        else:
+            if len(run) > 1:
+                yield _with_nodes(way, run)
+            run = []
+
+    if len(run) == len(way.nodes):
+        yield way
+    elif len(run) > 1:
+        yield _with_nodes(way, run)
+
+
+def _with_nodes(way, nodes):
+    return type(way)(way.id, way.version, way.changeset, way.timestamp,
+                     way.uid, way.tags, tuple(nodes))
+
+
+def clip(elements, area, types=None, node_tags=None):
+    """
+    Yields the part of `elements` within `area`. Nodes outside it are
+    dropped, ways are cut into the parts running inside it (see `split_way`)
+    and relations lose the members that were dropped; relations left without
+    members are dropped too. Nodes must come before the ways and ways before
+    the relations, as they do in .osm and .pbf files.
+
+    Only the nodes inside the area are kept in memory (their ids). `types`
+    and `node_tags` (keys a yielded node must have) are applied after
+    clipping, since ways need every node of the area.
+    """
+    inside, kept_ways = set(), set()
+    node_tags = frozenset(node_tags or ())
+    want = lambda t: types is None or t in types
+
+    for e in elements:
+        element_type = ELEMENT_TYPES[type(e)]
+
+        if element_type is Node:
+            if area.contains(e.lon, e.lat):
+                inside.add(e.id)
+                if want(Node) and node_tags.issubset(e.tags):
+                    yield e
+
+        elif element_type is Way:
+            for part in split_way(e, inside):
+                kept_ways.add(part.id)
+                if want(Way):
+                    yield part
+
+        elif want(Relation):
+            members = tuple(m for m in e.members
+                            if m.type is Relation
+                            or m.type is Node and m.member_id in inside
+                            or m.type is Way and m.member_id in kept_ways)
+            if len(members) == len(e.members):
+                yield e
+            elif members:
+                yield type(e)(e.id, e.version, e.changeset, e.timestamp,
+                              e.uid, e.tags, members)
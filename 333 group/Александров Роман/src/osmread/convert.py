@@ -0,0 +1,81 @@
+import sys
+from argparse import ArgumentParser
+
+from osmread import parse_file, Node, Way, Relation
+from osmread.writer.pbf import PbfWriter
+
+
+def convert(source, target, way_tags=None, node_tags=None,
+            relation_tags=None, metadata=True, **kwargs):
+    """
+    Converts `source` (any format `parse_file` reads) into a .pbf file.
+
+    Without `way_tags` everything is copied. With it only a subset is
+    written: the ways having all of `way_tags`, the nodes they reference,
+    nodes having all of `node_tags` and relations having all of
+    `relation_tags` (no relations if it is None). The ways and relations are
+    kept in memory while the nodes are read in a second pass.
+    """
+    kwargs['metadata'] = metadata
+
+    with open(target, 'wb') as fp:
+        with PbfWriter(fp) as writer:
+            if not way_tags:
+                for e in parse_file(source, **kwargs):
+                    writer.write(e)
+                return
+
+            types, require_tags = {Way}, {Way: way_tags}
+            if relation_tags:
+                types.add(Relation)
+                require_tags[Relation] = relation_tags
+
+            ways, relations, node_ids = [], [], set()
+            for e in parse_file(source, types=types,
+                                require_tags=require_tags, **kwargs):
+                if isinstance(e, Way):
+                    ways.append(e)
+                    node_ids.update(e.nodes)
+                else:
+                    relations.append(e)
+
+            node_tags = frozenset(node_tags or ())
+            for node in parse_file(source, types={Node}, **kwargs):
+                if node.id in node_ids or \
+                        node_tags and node_tags.issubset(node.tags):
+                    writer.write(node)
+
+            for e in ways:
+                writer.write(e)
+            for e in relations:
+                writer.write(e)
+
+
+def main(argv=sys.argv):
+    argparser = ArgumentParser(
+        description='Convert an OSM file (e.g. .osm XML) into .pbf')
+
+    argparser.add_argument('source', type=str)
+    argparser.add_argument('target', type=str)
+
+    argparser.add_argument('-f', dest='format', metavar='format', type=str,
+        help='source format: xml or pbf')
+    argparser.add_argument('--ways', metavar='key', nargs='+',
+        help='keep only ways with these tag keys (e.g. highway) and their nodes')
+    argparser.add_argument('--nodes', metavar='key', nargs='+',
+        help='with --ways: also keep nodes with these tag keys (e.g. amenity)')
+    argparser.add_argument('--relations', metavar='key', nargs='+',
+        help='with --ways: also keep relations with these tag keys')
+    argparser.add_argument('--no-metadata', dest='metadata', action='store_false',
+        help="don't write version, timestamp, changeset and uid")
+
+    args = argparser.parse_args(argv[1:])
+
+    options = {'format': args.format} if args.format else {}
+    convert(args.source, args.target, way_tags=args.ways,
+            node_tags=args.nodes, relation_tags=args.relations,
+            metadata=args.metadata, **options)
+
+
+if __name__ == '__main__':
+    main()
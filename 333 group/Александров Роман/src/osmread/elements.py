@@ -1,4 +1,13 @@
+from array import array
 from collections import namedtuple
+try:
+    from sys import intern
+except ImportError:
+    intern = lambda s: s  # unicode strings can't be interned in Python 2
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = dict
 
 __einfo = ('id', 'version', 'changeset', 'timestamp', 'uid')
 
@@ -8,4 +17,103 @@ Relation = namedtuple('Relation', __einfo + ('tags', 'members', ))
 
 RelationMember = namedtuple('RelationMember', ('role', 'type', 'member_id'))
 
+# Entry of an osmChange (.osc) file: `action` is one of ACTIONS
+Change = namedtuple('Change', ('action', 'element'))
+ACTIONS = ('create', 'modify', 'delete')
+
+# Columnar chunks yielded in the batch mode. `ids`, `lons`, `lats`, `refs`,
+# `member_ids` and `member_types` are NumPy arrays; `refs` and the member
+# columns of the i-th element are sliced by `offsets[i]:offsets[i + 1]`.
+# `tags` is a sparse dict {row: tags} with interned strings.
+NodeBatch = namedtuple('NodeBatch', ('ids', 'lons', 'lats', 'tags'))
+WayBatch = namedtuple('WayBatch', ('ids', 'offsets', 'refs', 'tags'))
+RelationBatch = namedtuple('RelationBatch', (
+    'ids', 'offsets', 'member_ids', 'member_types', 'member_roles', 'tags'))
+
 TYPE_NODE, TYPE_WAY, TYPE_RELATION = range(3)
+
+# Shared read-only tags of every compact element without tags
+EMPTY_TAGS = MappingProxyType({})
+
+try:
+    array('q')
+    _REF_TYPECODE = 'q'
+except ValueError:
+    _REF_TYPECODE = 'l'  # Python 2
+
+
+def _compact_tags(tags):
+    if not tags:
+        return EMPTY_TAGS
+    return dict((intern(k), v) for k, v in tags.items())
+
+
+class _CompactElement(object):
+    """
+    Memory-saving element record: slots instead of a tuple, no metadata
+    (`version`, `changeset`, `timestamp` and `uid` are always None), interned
+    tag keys and `EMPTY_TAGS` shared by all untagged elements. The
+    constructor takes the same arguments as the matching namedtuple.
+    """
+    __slots__ = ()
+    _fields = ()
+    version = changeset = timestamp = uid = None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in self._fields))
+
+    def __reduce__(self):
+        # EMPTY_TAGS can't be pickled, the constructor restores it
+        return type(self), (self.id, None, None, None, None, dict(self.tags)) \
+            + tuple(getattr(self, f) for f in self._fields[2:])
+
+
+class CompactNode(_CompactElement):
+    __slots__ = _fields = ('id', 'tags', 'lon', 'lat')
+
+    def __init__(self, id, version=None, changeset=None, timestamp=None,
+                 uid=None, tags=None, lon=None, lat=None):
+        self.id = id
+        self.tags = _compact_tags(tags)
+        self.lon = lon
+        self.lat = lat
+
+
+class CompactWay(_CompactElement):
+    "`nodes` is an array of int64 instead of a tuple of ints"
+    __slots__ = _fields = ('id', 'tags', 'nodes')
+
+    def __init__(self, id, version=None, changeset=None, timestamp=None,
+                 uid=None, tags=None, nodes=()):
+        self.id = id
+        self.tags = _compact_tags(tags)
+        self.nodes = array(_REF_TYPECODE, nodes)
+
+
+class CompactRelation(_CompactElement):
+    __slots__ = _fields = ('id', 'tags', 'members')
+
+    def __init__(self, id, version=None, changeset=None, timestamp=None,
+                 uid=None, tags=None, members=()):
+        self.id = id
+        self.tags = _compact_tags(tags)
+        self.members = tuple(members)
+
+
+# Classes built by the parsers for each element type
+ELEMENT_CLASSES = {Node: Node, Way: Way, Relation: Relation}
+COMPACT_CLASSES = {Node: CompactNode, Way: CompactWay, Relation: CompactRelation}
+
+# Element class -> element type
+ELEMENT_TYPES = dict((cls, t) for classes in (ELEMENT_CLASSES, COMPACT_CLASSES)
+                     for t, cls in classes.items())
@@ -1,22 +1,103 @@
-from bz2 import BZ2File
+from osmread.clip import clip, make_area
+from osmread.parser.compression import open_file
+from osmread.elements import (
+    Node, Way, Relation, ELEMENT_CLASSES, COMPACT_CLASSES
+)
+
+
+def _required_tags_by_type(require_tags):
+    "`require_tags` is either a set of keys or a dict {element type: keys}"
+    if not require_tags:
+        return {}
+    if isinstance(require_tags, dict):
+        return dict((t, frozenset(keys))
+                    for t, keys in require_tags.items() if keys)
+    keys = frozenset(require_tags)
+    return {Node: keys, Way: keys, Relation: keys}
+
 
 class Parser(object):
 
     def __init__(self, **kwargs):
         self._compression = kwargs.get('compression', None)
+        # decompression on a background thread (threads > 1: parallel bz2)
+        self._decompress_threads = kwargs.get('decompress_threads', None)
+        self._workers = kwargs.get('workers', None)
+        self._batch = kwargs.get('batch', False)
+        self._batch_size = kwargs.get('batch_size', 8000)
+        # element type -> class of the yielded objects
+        compact = kwargs.get('compact', False)
+        self._classes = COMPACT_CLASSES if compact else ELEMENT_CLASSES
+        # version, changeset, timestamp and uid are left None if disabled;
+        # compact elements don't keep them anyway
+        self._metadata = kwargs.get('metadata', not compact)
+        # filters: element types to keep and tag keys they must have
+        self._types = kwargs.get('types', None)
+        self._require_tags = _required_tags_by_type(
+            kwargs.get('require_tags', None))
+        # osmread.stats.ParseStats to fill in (time split, bytes read)
+        self._stats = kwargs.get('stats', None)
+
+        # clipping to an area: ways need the coordinates of all nodes, so
+        # the node filters are applied by the clipping instead
+        self._area = make_area(kwargs.get('bbox', None),
+                               kwargs.get('polygon', None))
+        if self._area is not None:
+            if self._batch:
+                raise ValueError('Clipping is not supported in batch mode')
+            self._clip_types = self._types
+            self._clip_node_tags = self._require_tags.pop(Node, None)
+            if self._types is not None:
+                self._types = set(self._types) | {Node}
+                if Relation in self._types:
+                    self._types.add(Way)
+
+    def _map_parallel(self, func, tasks):
+        """
+        Runs `func(self, task)` in a pool of `self._workers` processes and
+        yields the results in the order of `tasks`. Only a few tasks ahead
+        of the consumer are submitted, so memory use stays bounded.
+        """
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=self._workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(func, self, task))
+                if len(pending) >= 2 * self._workers:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    def _has_tags(self, element_type, tags):
+        keys = self._require_tags.get(element_type)
+        return not keys or all(k in tags for k in keys)
+
+    def _filter_tags(self, element_type, elements):
+        if element_type not in self._require_tags:
+            return elements
+        return (e for e in elements if self._has_tags(element_type, e.tags))
+
+    def _clip(self, elements):
+        "Applies the `bbox` or `polygon` option to parsed elements"
+        if self._area is None:
+            return elements
+        return clip(elements, self._area, self._clip_types,
+                    self._clip_node_tags)
 
     def parse(fp):
         pass
 
     def parse_file(self, filename):
-        if self._compression == 'bz2':
-            fp = BZ2File(filename, 'r')
-        else:
-            fp = open(filename, 'rb')
+        fp = open_file(filename, self._compression, self._decompress_threads)
+        if self._stats is not None:
+            fp = self._stats.timed_reader(
+                fp, 'decompress' if self._compression else 'read')
 
         try:
-            for e in self.parse(fp):
+            for e in self._clip(self.parse(fp)):
                 yield e
-        except Exception:
+        finally:
             fp.close()
-            raise
@@ -0,0 +1,199 @@
+"""
+Opening of compressed input files: bz2, gzip, xz and zstd, optionally with
+decompression running on background threads.
+"""
+from collections import deque
+from functools import partial
+from itertools import chain
+import re
+import threading
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+COMPRESSIONS = ('bz2', 'gzip', 'xz', 'zstd')
+
+# Extensions used for autodetection
+SUFFIXES = {'.bz2': 'bz2', '.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+
+CHUNK_SIZE = 1 << 20
+
+# Start of a bz2 stream: signature, block size and the block magic (pi)
+_BZ2_STREAM = re.compile(br'BZh[1-9]1AY&SY')
+
+_EOF = object()
+
+
+def open_file(filename, compression=None, threads=None):
+    """
+    Opens `filename` for binary reading. With `threads` set, decompression
+    runs on a background thread (a pool of them for multi-stream bz2 files)
+    and the returned object reads from a bounded buffer filled by it.
+    """
+    if not threads:
+        return _open(filename, compression)
+
+    if compression == 'bz2' and threads > 1:
+        chunks = _iter_bz2_parallel(filename, threads)
+    else:
+        chunks = _iter_chunks(filename, compression)
+    return ThreadedReader(chunks)
+
+
+def _open(filename, compression):
+    if compression is None:
+        return open(filename, 'rb')
+    elif compression == 'bz2':
+        from bz2 import BZ2File
+        return BZ2File(filename, 'r')
+    elif compression == 'gzip':
+        from gzip import GzipFile
+        return GzipFile(filename, 'rb')
+    elif compression == 'xz':
+        from lzma import LZMAFile
+        return LZMAFile(filename, 'rb')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), closefd=True)
+    else:
+        raise ValueError('Unknown compression: %s' % compression)
+
+
+def _iter_chunks(filename, compression):
+    fp = _open(filename, compression)
+    try:
+        for chunk in iter(partial(fp.read, CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        fp.close()
+
+
+def _decompress_bz2(blocks):
+    "Sequential decompression of a bz2 file that may hold several streams"
+    from bz2 import BZ2Decompressor
+
+    decompressor = BZ2Decompressor()
+    for data in blocks:
+        while data:
+            out = decompressor.decompress(data)
+            if out:
+                yield out
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = BZ2Decompressor()
+            else:
+                data = b''
+
+
+def _iter_bz2_parallel(filename, threads, block_size=4 << 20,
+                       max_carry=32 << 20):
+    """
+    Decompresses multi-stream bz2 files (as written by pbzip2 or lbzip2) on a
+    pool of threads; bz2 releases the GIL while decompressing. The input is
+    cut at stream starts and the pieces are decompressed independently.
+    A single-stream file can't be cut this way and is decompressed on one
+    thread once `max_carry` bytes without a stream start are seen.
+    """
+    from bz2 import decompress
+    from concurrent.futures import ThreadPoolExecutor
+
+    with open(filename, 'rb') as fp:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            pending = deque()
+            carry = b''
+            for data in iter(partial(fp.read, block_size), b''):
+                carry += data
+                cut = None
+                for match in _BZ2_STREAM.finditer(carry, 1):
+                    cut = match.start()
+
+                if cut:
+                    pending.append(pool.submit(decompress, carry[:cut]))
+                    carry = carry[cut:]
+                    while len(pending) > 2 * threads:
+                        yield pending.popleft().result()
+                elif len(carry) > max_carry:
+                    break
+
+            while pending:
+                yield pending.popleft().result()
+
+        rest = iter(partial(fp.read, block_size), b'')
+        for out in _decompress_bz2(chain([carry], rest)):
+            yield out
+
+
+class ThreadedReader(object):
+    "Read-only file object fed with chunks produced on a background thread"
+
+    def __init__(self, chunks, buffers=8):
+        self._queue = Queue(maxsize=buffers)
+        self._stop = threading.Event()
+        self._buf = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self.__produce, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self.__put(chunk):
+                    return
+            self.__put(_EOF)
+        except BaseException as exc:
+            self.__put(exc)
+        finally:
+            chunks.close()
+
+    def __put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __next_chunk(self):
+        if self._eof:
+            return False
+        item = self._queue.get()
+        if item is _EOF:
+            self._eof = True
+            return False
+        elif isinstance(item, BaseException):
+            self._eof = True
+            raise item
+        self._buf, self._pos = item, 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._buf) and not self.__next_chunk():
+                break
+            available = len(self._buf) - self._pos
+            take = available if size < 0 else min(size, available)
+            parts.append(self._buf[self._pos:self._pos + take])
+            self._pos += take
+            if size > 0:
+                size -= take
+        return b''.join(parts)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
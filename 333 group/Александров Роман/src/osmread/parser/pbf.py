@@ -1,9 +1,21 @@
+from collections import namedtuple
+from itertools import repeat
 from struct import unpack
+from timeit import default_timer
+import os
 import zlib
 import sys
 
 from osmread.parser import Parser
-from osmread.elements import Node, Way, Relation, RelationMember
+from osmread.elements import (
+    Node, Way, Relation, RelationMember, NodeBatch, intern
+)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    from osmread.batch import iter_batches, NodeBatchBuilder
 if sys.version_info > (3,):
     from osmread.protobuf.fileformat_pb2 import BlobHeader, Blob
     from osmread.protobuf.osmformat_pb2 import HeaderBlock, PrimitiveBlock
@@ -20,14 +32,54 @@ class PBFNotImplemented(PBFException):
     pass
 
 
+# Content kinds of a blob, stored as a bit mask in the index
+KIND_NODES, KIND_DENSE, KIND_WAYS, KIND_RELATIONS = 1, 2, 4, 8
+
+_TYPE_KINDS = {
+    Node: KIND_NODES | KIND_DENSE,
+    Way: KIND_WAYS,
+    Relation: KIND_RELATIONS,
+}
+
+INDEX_SUFFIX = '.idx'
+_INDEX_MAGIC = 'osmread-pbf-index 1'
+
+BlobIndexEntry = namedtuple('BlobIndexEntry', ('offset', 'size', 'kinds'))
+
+
+_NO_INFO = (None, None, None, None)
+
+
+def _has_sids(keys, required):
+    return all(not sids.isdisjoint(keys) for sids in required)
+
+
+def _parse_blob(parser, blob):
+    "Worker entry point for the parallel mode: decodes one OSMData blob"
+    return list(parser._parse_blob(blob))
+
+
 class PbfParser(Parser):
 
     def __init__(self, **kwargs):
         Parser.__init__(self, **kwargs)
+        self._index = kwargs.get('index', False)
+
+        if self._batch and np is None:
+            raise ImportError('Batch mode requires NumPy')
+
+    def parse_file(self, filename):
+        index = self.load_index(filename) if self._index else None
 
-    def parse(self, fp):
+        with open(filename, 'rb') as fp:
+            if self._stats is not None:
+                fp = self._stats.timed_reader(fp)
+            for e in self._clip(self.parse(fp, index)):
+                yield e
+
+    def parse(self, fp, index=None):
         blob_header = self.__read_blob_header(fp, 'OSMHeader')
-        blob_data = self.__read_blob_data(fp, blob_header)
+        blob_data = self.__decode_blob(fp.read(blob_header.datasize))
 
         header_block = HeaderBlock()
         header_block.ParseFromString(blob_data)
@@ -38,6 +90,23 @@ class PbfParser(Parser):
                     'Required feature %s not implemented!',
                     feature)
 
+        if index is None:
+            blobs = self.__read_blobs(fp)
+        else:
+            blobs = self.__read_indexed_blobs(fp, index)
+
+        if self._workers and self._workers > 1:
+            # Headers are read here, one after another, while decompression
+            # and PrimitiveBlock decoding run in the pool
+            blocks = self._map_parallel(_parse_blob, blobs)
+        else:
+            blocks = (self._parse_blob(blob) for blob in blobs)
+
+        for block in blocks:
+            for e in block:
+                yield e
+
+    def __read_blobs(self, fp):
         while True:
             blob_header = self.__read_blob_header(fp, 'OSMData')
 
@@ -45,23 +114,169 @@ class PbfParser(Parser):
                 # EOF
                 break
 
-            blob_data = self.__read_blob_data(fp, blob_header)
+            yield fp.read(blob_header.datasize)
+
+    def __read_indexed_blobs(self, fp, index):
+        wanted = self.__wanted_kinds()
+
+        for entry in index:
+            if entry.kinds & wanted:
+                fp.seek(entry.offset)
+                yield fp.read(entry.size)
+
+    def __wanted_kinds(self):
+        if self._types is None:
+            return KIND_NODES | KIND_DENSE | KIND_WAYS | KIND_RELATIONS
+
+        wanted = 0
+        for t in self._types:
+            wanted |= _TYPE_KINDS[t]
+        return wanted
+
+    def build_index(self, fp):
+        """
+        Walks the whole file once and returns a list of `BlobIndexEntry`
+        with the offset, size and content kinds of every OSMData blob.
+        """
+        blob_header = self.__read_blob_header(fp, 'OSMHeader')
+        fp.seek(blob_header.datasize, os.SEEK_CUR)
+
+        index = []
+        while True:
+            blob_header = self.__read_blob_header(fp, 'OSMData')
+
+            if not blob_header:
+                break
+
+            offset = fp.tell()
             pblock = PrimitiveBlock()
-            pblock.ParseFromString(blob_data)
+            pblock.ParseFromString(
+                self.__decode_blob(fp.read(blob_header.datasize)))
 
+            kinds = 0
             for group in pblock.primitivegroup:
                 if len(group.nodes) > 0:
-                    for i in self.__parse_nodes(pblock, group.nodes):
-                        yield i
+                    kinds |= KIND_NODES
                 elif len(group.dense.id) > 0:
-                    for i in self.__parse_dense(pblock, group.dense):
-                        yield i
+                    kinds |= KIND_DENSE
                 elif len(group.ways) > 0:
-                    for i in self.__parse_ways(pblock, group.ways):
-                        yield i
+                    kinds |= KIND_WAYS
                 elif len(group.relations) > 0:
-                    for i in self.__parse_relations(pblock, group.relations):
-                        yield i
+                    kinds |= KIND_RELATIONS
+
+            index.append(BlobIndexEntry(offset, blob_header.datasize, kinds))
+
+        return index
+
+    def load_index(self, filename):
+        """
+        Returns the blob index of `filename`. The index is kept next to the
+        file (`foo.osm.pbf.idx`) and is rebuilt when the file has changed.
+        """
+        stat = os.stat(filename)
+        signature = '%s %d %d' % (_INDEX_MAGIC, stat.st_size, int(stat.st_mtime))
+        index_filename = filename + INDEX_SUFFIX
+
+        try:
+            with open(index_filename, 'r') as f:
+                if f.readline().rstrip('\n') == signature:
+                    return [BlobIndexEntry(*map(int, line.split()))
+                            for line in f]
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+        with open(filename, 'rb') as fp:
+            index = self.build_index(fp)
+
+        try:
+            with open(index_filename, 'w') as f:
+                f.write(signature + '\n')
+                for entry in index:
+                    f.write('%d %d %d\n' % entry)
+        except (IOError, OSError):
+            pass  # read-only location, the index just won't be persisted
+
+        return index
+
+    def _parse_blob(self, blob):
+        stats = self._stats
+        data = self.__decode_blob(blob)
+
+        if stats is not None:
+            t0 = default_timer()
+        pblock = PrimitiveBlock()
+        pblock.ParseFromString(data)
+        if stats is not None:
+            stats.add('decode', default_timer() - t0)
+
+        strings = None
+
+        for group in pblock.primitivegroup:
+            dense = False
+            if len(group.nodes) > 0:
+                element_type, data = Node, group.nodes
+            elif len(group.dense.id) > 0:
+                element_type, data, dense = Node, group.dense, True
+            elif len(group.ways) > 0:
+                element_type, data = Way, group.ways
+            elif len(group.relations) > 0:
+                element_type, data = Relation, group.relations
+            else:
+                continue
+
+            if self._types is not None and element_type not in self._types:
+                continue
+
+            required = self.__required_sids(pblock, element_type)
+            if required is False:
+                # the block has no strings for some of the required keys
+                continue
+
+            if strings is None:
+                strings = self.__decode_strings(pblock)
+
+            if dense:
+                if self._batch:
+                    batch = self.__parse_dense_batch(pblock, strings, data)
+                    if len(batch.ids) > 0:
+                        yield batch
+                    continue
+                elif np is not None:
+                    elements = self.__parse_dense_columns(pblock, strings, data)
+                else:
+                    elements = self._filter_tags(
+                        Node, self.__parse_dense(pblock, strings, data))
+            elif element_type is Node:
+                elements = self.__parse_nodes(pblock, strings, data, required)
+            elif element_type is Way:
+                elements = self.__parse_ways(strings, data, required)
+            else:
+                elements = self.__parse_relations(strings, data, required)
+
+            if self._batch:
+                elements = iter_batches(elements, self._batch_size)
+
+            for i in elements:
+                yield i
+
+    def __required_sids(self, pblock, element_type):
+        """
+        Translates the tag keys required for `element_type` into the block's
+        string table ids: a list with a set of ids per key. Returns None if
+        no tags are required and False if the block can't contain a match.
+        """
+        keys = self._require_tags.get(element_type)
+        if not keys:
+            return None
+
+        sids = dict((key.encode('utf-8'), set()) for key in keys)
+        for i, s in enumerate(pblock.stringtable.s):
+            if s in sids:
+                sids[s].add(i)
+
+        if not all(sids.values()):
+            return False
+        return list(sids.values())
 
     def __read_blob_header(self, fp, header_type):
         buf = fp.read(4)
@@ -81,46 +296,64 @@ class PbfParser(Parser):
 
         return msg
 
-    def __read_blob_data(self, fp, blob_header):
+    def __decode_blob(self, data):
+        stats = self._stats
+        if stats is not None:
+            t0 = default_timer()
+
         msg = Blob()
-        msg.ParseFromString(fp.read(blob_header.datasize))
+        msg.ParseFromString(data)
+
+        if stats is not None:
+            t1 = default_timer()
+            stats.add('decode', t1 - t0)
 
         if len(msg.raw) > 0:
             return msg.raw
         elif len(msg.zlib_data) > 0:
-            return zlib.decompress(msg.zlib_data)
+            data = zlib.decompress(msg.zlib_data)
+            if stats is not None:
+                stats.add('decompress', default_timer() - t1)
+            return data
         else:
             raise PBFNotImplemented("Unsupported data type!")
 
-    def __parse_tags(self, itm, pblock):
-        d = dict()
-        for k, v in zip(itm.keys, itm.vals):
-            d[pblock.stringtable.s[k].decode('utf-8')] = \
-                pblock.stringtable.s[v].decode('utf-8')
-        return d
+    def __decode_strings(self, pblock):
+        "Decodes the string table once for all elements of the block"
+        return [intern(s.decode('utf-8')) for s in pblock.stringtable.s]
+
+    def __parse_tags(self, itm, strings):
+        return dict((strings[k], strings[v]) for k, v in zip(itm.keys, itm.vals))
 
-    def __parse_nodes(self, pblock, data):
+    def __parse_info(self, e):
+        if not self._metadata or not e.HasField('info'):
+            return _NO_INFO
+        info = e.info
+        return info.version, int(info.changeset), int(info.timestamp), info.uid
+
+    def __parse_nodes(self, pblock, strings, data, required=None):
         granularity = pblock.granularity
         lon_offset = pblock.lon_offset
         lat_offset = pblock.lat_offset
 
+        node_class = self._classes[Node]
+
         for e in data:
-            try:
-                uid = e.info.uid
-            except:
-                uid = 0  # An obj can miss an uid (when anonymous edits were possible)
-            yield Node(
+            if required and not _has_sids(e.keys, required):
+                continue
+            version, changeset, timestamp, uid = self.__parse_info(e)
+            yield node_class(
                 id=e.id,
-                version=e.info.version,
-                changeset=int(e.info.changeset),
-                timestamp=int(e.info.timestamp),
-                uid = uid,
-                tags=self.__parse_tags(e, pblock),
+                version=version,
+                changeset=changeset,
+                timestamp=timestamp,
+                uid=uid,
+                tags=self.__parse_tags(e, strings),
                 lon=float(e.lon * granularity + lon_offset) / long(1000000000),
                 lat=float(e.lat * granularity + lat_offset) / long(1000000000),
             )
 
-    def __parse_dense(self, pblock, data):
+    def __parse_dense(self, pblock, strings, data):
         node_granularity = pblock.granularity
         timestamp_granularity = pblock.date_granularity
         lon_offset = pblock.lon_offset
@@ -132,12 +365,23 @@ class PbfParser(Parser):
         cts = 0
         ccs = 0
         tag_idx = 0
+        node_class = self._classes[Node]
+
+        info = data.denseinfo
+        if len(info.version) == len(data.id):
+            metadata = self._metadata
+            versions, uids, timestamps, changesets = \
+                info.version, info.uid, info.timestamp, info.changeset
+        else:
+            # the writer may omit DenseInfo altogether
+            metadata = False
+            versions = uids = timestamps = changesets = repeat(0)
 
         for did, version, dlon, dlat, duid, dts, dcs in zip(
-                data.id, data.denseinfo.version,
+                data.id, versions,
                 data.lon, data.lat,
-                data.denseinfo.uid, data.denseinfo.timestamp,
-                data.denseinfo.changeset):
+                uids, timestamps,
+                changesets):
             cid += did
             clon += dlon
             clat += dlat
@@ -151,12 +395,17 @@ class PbfParser(Parser):
                     k = data.keys_vals[tag_idx]
                     v = data.keys_vals[tag_idx + 1]
                     tag_idx += 2
-                    tags[pblock.stringtable.s[k].decode('utf-8')] = \
-                        pblock.stringtable.s[v].decode('utf-8')
+                    tags[strings[k]] = strings[v]
 
             tag_idx += 1
 
-            yield Node(
+            if not metadata:
+                yield node_class(cid, None, None, None, None, tags,
+                           float(clon * node_granularity + lon_offset) / long(1000000000),
+                           float(clat * node_granularity + lat_offset) / long(1000000000))
+                continue
+
+            yield node_class(
                 id=cid,
                 version=version,
                 changeset=int(ccs),
@@ -167,26 +416,128 @@ class PbfParser(Parser):
                 lat=float(clat * node_granularity + lat_offset) / long(1000000000),
             )
 
-    def __parse_ways(self, pblock, data):
+    def __dense_coords(self, pblock, data):
+        ids = np.cumsum(np.array(data.id, dtype=np.int64))
+        lons = (np.cumsum(np.array(data.lon, dtype=np.int64))
+                * pblock.granularity + pblock.lon_offset) / 1e9
+        lats = (np.cumsum(np.array(data.lat, dtype=np.int64))
+                * pblock.granularity + pblock.lat_offset) / 1e9
+        return ids, lons, lats
+
+    def __parse_dense_columns(self, pblock, strings, data):
+        "Same as `__parse_dense`, but delta decoding is done on whole columns"
+        count = len(data.id)
+        ids, lons, lats = self.__dense_coords(pblock, data)
+
+        info = data.denseinfo
+        if not self._metadata:
+            versions = changesets = timestamps = uids = [None] * count
+        elif len(info.version) == count:
+            versions = info.version
+            changesets = np.cumsum(
+                np.array(info.changeset, dtype=np.int64)).tolist()
+            timestamps = (np.cumsum(np.array(info.timestamp, dtype=np.int64))
+                          * pblock.date_granularity // 1000).tolist()
+            uids = np.cumsum(np.array(info.uid, dtype=np.int64)).tolist()
+        else:
+            versions = changesets = timestamps = uids = [None] * count
+
+        tags = self.__parse_dense_tags(strings, data.keys_vals, count)
+        if tags is None:
+            # keys_vals can't be split on zeros (an empty string as a value)
+            nodes = self.__parse_dense(pblock, strings, data)
+            for i in self._filter_tags(Node, nodes):
+                yield i
+            return
+
+        columns = zip(ids.tolist(), versions, changesets, timestamps,
+                      uids, tags, lons.tolist(), lats.tolist())
+        if Node in self._require_tags:
+            columns = (c for c in columns if self._has_tags(Node, c[5]))
+
+        node_class = self._classes[Node]
+        for args in columns:
+            yield node_class(*args)
+
+    def __parse_dense_batch(self, pblock, strings, data):
+        count = len(data.id)
+        tags = self.__parse_dense_tags(strings, data.keys_vals, count)
+        if tags is None:
+            builder = NodeBatchBuilder()
+            nodes = self.__parse_dense(pblock, strings, data)
+            for node in self._filter_tags(Node, nodes):
+                builder.add(node)
+            return builder.build()
+
+        ids, lons, lats = self.__dense_coords(pblock, data)
+        if Node in self._require_tags:
+            rows = [i for i, t in enumerate(tags) if self._has_tags(Node, t)]
+            ids, lons, lats = ids[rows], lons[rows], lats[rows]
+            tags = [tags[i] for i in rows]
+
+        return NodeBatch(
+            ids=ids, lons=lons, lats=lats,
+            tags=dict((i, t) for i, t in enumerate(tags) if t),
+        )
+
+    def __parse_dense_tags(self, strings, keys_vals, count):
+        """
+        Splits `keys_vals` on the zero separators into per-node tag dicts.
+        Returns None if the split is ambiguous.
+        """
+        if len(keys_vals) == 0:
+            return [{} for _ in range(count)]
+
+        ends = np.flatnonzero(np.array(keys_vals, dtype=np.int64) == 0)
+        if len(ends) != count:
+            return None
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        if np.any((ends - starts) % 2):
+            return None
+
+        tags = [{} for _ in range(count)]
+        starts, ends = starts.tolist(), ends.tolist()
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if start == end:
+                continue
+            d = tags[i]
+            for j in range(start, end, 2):
+                d[strings[keys_vals[j]]] = strings[keys_vals[j + 1]]
+        return tags
+
+    def __parse_ways(self, strings, data, required=None):
+        way_class = self._classes[Way]
+
         for e in data:
+            if required and not _has_sids(e.keys, required):
+                continue
+
             nid = 0
             nodes = []
             for delta in e.refs:
                 nid += delta
                 nodes.append(nid)
 
-            yield Way(
+            version, changeset, timestamp, uid = self.__parse_info(e)
+            yield way_class(
                 id=e.id,
-                version=e.info.version,
-                changeset=int(e.info.changeset),
-                timestamp=int(e.info.timestamp),
-                uid=e.info.uid,
-                tags=self.__parse_tags(e, pblock),
+                version=version,
+                changeset=changeset,
+                timestamp=timestamp,
+                uid=uid,
+                tags=self.__parse_tags(e, strings),
                 nodes=tuple(nodes),
             )
 
-    def __parse_relations(self, pblock, data):
+    def __parse_relations(self, strings, data, required=None):
+        relation_class = self._classes[Relation]
+
         for e in data:
+            if required and not _has_sids(e.keys, required):
+                continue
+
             members = []
             mid = 0
             for role_id, mtype, mid_delta in zip(
@@ -194,18 +545,19 @@ class PbfParser(Parser):
                 mid += mid_delta
                 members.append(
                     RelationMember(
-                        pblock.stringtable.s[role_id].decode('utf-8'),
+                        strings[role_id],
                         (Node, Way, Relation)[mtype],
                         mid
                     )
                 )
 
-            yield Relation(
+            version, changeset, timestamp, uid = self.__parse_info(e)
+            yield relation_class(
                 id=e.id,
-                version=e.info.version,
-                changeset=int(e.info.changeset),
-                timestamp=int(e.info.timestamp),
-                uid=e.info.uid,
-                tags=self.__parse_tags(e, pblock),
+                version=version,
+                changeset=changeset,
+                timestamp=timestamp,
+                uid=uid,
+                tags=self.__parse_tags(e, strings),
                 members=tuple(members)
             )
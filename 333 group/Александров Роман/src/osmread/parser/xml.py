@@ -1,27 +1,129 @@
+from io import BytesIO
+import os
+import re
 import sys
-from datetime import datetime
-from time import mktime
 try:
     from lxml.etree import iterparse
 except ImportError:
     from xml.etree.ElementTree import iterparse
 
 from osmread.parser import Parser
-from osmread.elements import Node, Way, Relation, RelationMember
+from osmread.elements import Node, Way, Relation, RelationMember, Change, ACTIONS
 
 # Support for Python 3.x & 2.x
 if sys.version_info > (3,):
     long = int
     unicode = str
 
+_ELEMENT_TYPES = {'node': Node, 'way': Way, 'relation': Relation}
+
+# Opening tag of a top-level element. These are never nested and `<` can't
+# appear unescaped in attribute values, so any match is an element boundary.
+_ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+
+_days_cache = {}
+
+
+def _parse_timestamp(text):
+    "'2017-05-01T12:30:00Z' -> seconds since the epoch, integer arithmetic only"
+    date = text[:10]
+    days = _days_cache.get(date)
+    if days is None:
+        # days from the civil date, counting years from March
+        year, month, day = int(text[0:4]), int(text[5:7]), int(text[8:10])
+        if month <= 2:
+            year -= 1
+        era = year // 400
+        yoe = year - era * 400
+        doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+        doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+        days = _days_cache[date] = era * 146097 + doe - 719468
+
+    return days * 86400 + int(text[11:13]) * 3600 + \
+        int(text[14:16]) * 60 + int(text[17:19])
+
+
+def _find_element_start(fp, pos, end, block_size=1 << 20):
+    "Offset of the first top-level element starting at `pos` or later"
+    fp.seek(pos)
+    while pos < end:
+        # the overlap lets a tag split between two blocks be found
+        buf = fp.read(block_size + 16)
+        match = _ELEMENT_START.search(buf)
+        if match and match.start() < block_size:
+            return pos + match.start()
+        pos += block_size
+        fp.seek(pos)
+    return end
+
+
+def _split_ranges(fp, chunk_size):
+    """
+    Splits an uncompressed .osm file into (start, end) byte ranges, each one
+    holding whole top-level elements only
+    """
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(max(0, size - 4096))
+    tail = fp.read()
+    closing = tail.rfind(b'</osm>')
+    end = size - len(tail) + closing if closing >= 0 else size
+
+    start = _find_element_start(fp, 0, end)
+    ranges = []
+    while start < end:
+        stop = _find_element_start(fp, min(start + chunk_size, end), end)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def _parse_range(parser, task):
+    "Worker entry point for the parallel mode: parses one range of the file"
+    filename, start, end = task
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return list(parser.parse(BytesIO(b'<osm>' + data + b'</osm>')))
+
+
 class XmlParser(Parser):
 
     def __init__(self, **kwargs):
         Parser.__init__(self, **kwargs)
         self._compression = kwargs.get('compression', None)
+        self._chunk_size = kwargs.get('chunk_size', 16 << 20)
+        # osmChange input: elements are yielded as Change(action, element)
+        self._changes = kwargs.get('changes', False)
+        if self._changes and (self._batch or self._area is not None):
+            raise ValueError('Change files support neither batch mode '
+                             'nor clipping')
+
+    def parse_file(self, filename):
+        if not (self._workers and self._workers > 1) or self._compression \
+                or self._changes:
+            for e in Parser.parse_file(self, filename):
+                yield e
+            return
+
+        with open(filename, 'rb') as fp:
+            ranges = _split_ranges(fp, self._chunk_size)
+
+        tasks = ((filename, start, end) for start, end in ranges)
+        chunks = self._map_parallel(_parse_range, tasks)
+        for e in self._clip(e for chunk in chunks for e in chunk):
+            yield e
 
     def parse(self, fp):
+        if self._batch:
+            from osmread.batch import iter_batches
+            return iter_batches(self.__parse_elements(fp), self._batch_size)
+        return self.__parse_elements(fp)
+
+    def __parse_elements(self, fp):
         context = iterparse(fp, events=('start', 'end'))
+        if self._stats is not None:
+            context = self._stats.timed_iter(context)
 
         # common
         _type = None
@@ -38,52 +140,53 @@ class XmlParser(Parser):
         _nodes = None
         # relation only
         _members = None
+        # element filtered out by `types`, its children are ignored
+        _skip = False
+        # osmChange section the element is in
+        _action = None
+        changes = self._changes
+
+        types = self._types
+        metadata = self._metadata
+        classes = self._classes
 
         for event, elem in context:
 
             if event == 'start':
                 attrs = elem.attrib
-                if elem.tag in ('node', 'way', 'relation'):
-                    _id = long(attrs['id'])
-                    _version = int(attrs['version'])
-                    _changeset = int(attrs['changeset'])
-                    # TODO: improve timestamp parsing - dateutil too slow
-                    _tstxt = attrs['timestamp']
-                    _timestamp = int((
-                        datetime(
-                            year=int(_tstxt[0:4]),
-                            month=int(_tstxt[5:7]),
-                            day=int(_tstxt[8:10]),
-                            hour=int(_tstxt[11:13]),
-                            minute=int(_tstxt[14:16]),
-                            second=int(_tstxt[17:19]),
-                            tzinfo=None
-                        ) - datetime(
-                            year=1970,
-                            month=1,
-                            day=1,
-                            tzinfo=None
-                        )
-                    ).total_seconds())
+                if elem.tag in _ELEMENT_TYPES:
+                    _type = _ELEMENT_TYPES[elem.tag]
+                    _skip = types is not None and _type not in types
+                    if _skip:
+                        continue
 
-                    try: #An object can miss an uid (when anonymous edits were possible)
-                        _uid = int(attrs['uid'])
-                    except:
-                        uid = 0
+                    _id = long(attrs['id'])
+                    if metadata:
+                        _version = int(attrs['version'])
+                        _changeset = int(attrs['changeset'])
+                        _timestamp = _parse_timestamp(attrs['timestamp'])
+                        # An object can miss an uid (when anonymous edits were possible)
+                        _uid = int(attrs.get('uid', 0))
 
                     _tags = {}
 
-                    if elem.tag == 'node':
-                        _type = Node
-                        _lon = float(attrs['lon'])
-                        _lat = float(attrs['lat'])
-                    elif elem.tag == 'way':
-                        _type = Way
+                    if _type is Node:
+                        try:
+                            _lon = float(attrs['lon'])
+                            _lat = float(attrs['lat'])
+                        except KeyError:  # deleted nodes in change files
+                            _lon = _lat = None
+                    elif _type is Way:
                         _nodes = []
-                    elif elem.tag == 'relation':
-                        _type = Relation
+                    elif _type is Relation:
                         _members = []
 
+                elif elem.tag in ACTIONS:
+                    _action = elem.tag
+
+                elif _skip:
+                    pass
+
                 elif elem.tag == 'tag':
                     _tags[unicode(attrs['k'])] = unicode(attrs['v'])
 
@@ -94,31 +197,34 @@ class XmlParser(Parser):
                     _members.append(
                         RelationMember(
                             unicode(attrs['role']),
-                            {
-                                'node': Node,
-                                'way': Way,
-                                'relation': Relation
-                            }[attrs['type']],
+                            _ELEMENT_TYPES[attrs['type']],
                             long(attrs['ref'])
                         )
                     )
 
             elif event == 'end':
-                if elem.tag in ('node', 'way', 'relation'):
+                if elem.tag in _ELEMENT_TYPES:
+                    if _skip or not self._has_tags(_type, _tags):
+                        elem.clear()
+                        continue
+
                     args = [
                         _id, _version, _changeset,
                         _timestamp, _uid, _tags
                     ]
 
-                    if elem.tag == 'node':
+                    if _type is Node:
                         args.extend((_lon, _lat))
 
-                    elif elem.tag == 'way':
+                    elif _type is Way:
                         args.append(tuple(_nodes))
 
-                    elif elem.tag == 'relation':
+                    elif _type is Relation:
                         args.append(tuple(_members))
 
                     elem.clear()
 
-                    yield _type(*args)
+                    if changes:
+                        yield Change(_action, classes[_type](*args))
+                    else:
+                        yield classes[_type](*args)
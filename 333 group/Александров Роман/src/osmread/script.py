@@ -1,7 +1,120 @@
+from __future__ import print_function
+
+import os
 import sys
 from argparse import ArgumentParser
+from collections import defaultdict
+from timeit import default_timer
 
 from osmread import parse_file, Node, Way, Relation
+from osmread.stats import ParseStats, PHASES
+
+_MB = float(1 << 20)
+
+
+def _peak_rss():
+    """
+    Peak resident set sizes in bytes of this process and of the largest
+    of its (waited for) children, such as the worker processes; these are
+    separate maximums and don't add up to a total
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None  # Windows
+
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return tuple(resource.getrusage(who).ru_maxrss * scale
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def _kind(e):
+    if isinstance(e, Node):
+        return 'nodes'
+    elif isinstance(e, Way):
+        return 'ways'
+    elif isinstance(e, Relation):
+        return 'relations'
+    return type(e).__name__
+
+
+def bench(filename, options, profile=None):
+    """
+    Parses `filename` and returns a report: per element type counts, time
+    and input bytes, the time split between the parse phases and the peak
+    RSS of this process and of its largest child (a worker, with workers).
+    Time and bytes between two yielded elements go to the type of the latter.
+    """
+    stats = ParseStats()
+    counts, times, sizes = defaultdict(int), defaultdict(float), defaultdict(int)
+
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = last = default_timer()
+    last_bytes = 0
+    for e in parse_file(filename, stats=stats, **options):
+        now = default_timer()
+        kind = _kind(e)
+        counts[kind] += 1
+        times[kind] += now - last
+        sizes[kind] += stats.bytes_read - last_bytes
+        last, last_bytes = now, stats.bytes_read
+    total = default_timer() - start
+
+    if profile:
+        profiler.disable()
+        profiler.dump_stats(profile)
+
+    phases = dict(stats.times)
+    phases['construction'] = max(0.0, total - sum(stats.times.values()))
+
+    peak_rss, peak_child_rss = _peak_rss()
+    return {
+        'filename': filename,
+        'file_bytes': os.path.getsize(filename),
+        'input_bytes': stats.bytes_read,
+        'seconds': total,
+        'types': dict((kind, {
+            'count': counts[kind],
+            'seconds': times[kind],
+            'bytes': sizes[kind],
+        }) for kind in counts),
+        'phases': phases,
+        'peak_rss': peak_rss,
+        'peak_child_rss': peak_child_rss or None,
+        'options': options,
+    }
+
+
+def print_report(report, file=sys.stdout):
+    total = report['seconds'] or float('nan')
+    print("%s: %.1f MB in %.2f s, %.2f MB/s" % (
+        report['filename'], report['file_bytes'] / _MB, total,
+        report['file_bytes'] / _MB / total), file=file)
+
+    for kind, row in sorted(report['types'].items()):
+        seconds = row['seconds'] or float('nan')
+        print("  %-10s %10d  %10.0f el/s  %8.2f MB/s" % (
+            kind, row['count'], row['count'] / seconds,
+            row['bytes'] / _MB / seconds), file=file)
+
+    print("Time split:", ', '.join(
+        '%s %.2f s (%.0f%%)' % (phase, report['phases'][phase],
+                                100 * report['phases'][phase] / total)
+        for phase in PHASES + ('construction',)), file=file)
+    if report['options'].get('workers', 0) > 1:
+        print("(decoding runs in worker processes and is counted as "
+              "construction)", file=file)
+
+    if report['peak_rss'] is not None:
+        print("Peak RSS: %.1f MB" % (report['peak_rss'] / _MB), file=file)
+    if report['peak_child_rss'] is not None:
+        print("Peak RSS of the largest child process: %.1f MB" % (
+            report['peak_child_rss'] / _MB), file=file)
+
 
 def main(argv=sys.argv):
     argparser = ArgumentParser()
@@ -11,14 +124,37 @@ def main(argv=sys.argv):
     argparser.add_argument('-f', dest='format', metavar='format', type=str,
         help='file format: xml or pbf')
     argparser.add_argument('-c', dest='compression', metavar='compression', type=str,
-        help='override compression autodetection: bz2')
+        help='override compression autodetection: bz2, gzip, xz or zstd')
     argparser.add_argument('-d', dest='dump', action='store_true',
         help='dump elements to stdout (debug)')
+    argparser.add_argument('-t', dest='threads', metavar='threads', type=int,
+        help='decompress on background threads (several for multi-stream bz2)')
+    argparser.add_argument('-w', dest='workers', metavar='workers', type=int,
+        help='parse in a pool of this many processes (PBF or uncompressed XML)')
+    argparser.add_argument('--bench', action='store_true',
+        help='report throughput, time split between phases and peak RSS')
+    argparser.add_argument('--profile', metavar='file', type=str,
+        help='with --bench: write a cProfile dump')
+    argparser.add_argument('--json', metavar='file', type=str,
+        help='with --bench: write the report as JSON')
 
     args = argparser.parse_args(argv[1:])
 
+    options = dict(format=args.format, compression=args.compression,
+                   decompress_threads=args.threads, workers=args.workers)
+    options = dict((k, v) for k, v in options.items() if v is not None)
+
+    if args.bench:
+        report = bench(args.filename, options, profile=args.profile)
+        print_report(report)
+        if args.json:
+            import json
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        return
+
     element_count, node_count, way_count, relation_count = 0, 0, 0, 0
-    for e in parse_file(args.filename):
+    for e in parse_file(args.filename, **options):
         element_count += 1
 
         if isinstance(e, Node):
@@ -0,0 +1,60 @@
+"""
+Counters for profiling a parse. Pass a `ParseStats` instance as `stats=` to
+`parse_file` and the parser will add the time spent on reading,
+decompression and decoding (protobuf or XML) to it. Everything else the
+consumer waits for is object construction.
+"""
+from timeit import default_timer
+
+PHASES = ('read', 'decompress', 'decode')
+
+
+class ParseStats(object):
+
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        # bytes returned by the (decompressing) file object
+        self.bytes_read = 0
+        # time already counted by the inner timers, so that outer timers
+        # (e.g. iterparse calling read()) only keep their own share
+        self._inner = 0.0
+
+    def add(self, phase, seconds):
+        self.times[phase] += seconds
+        self._inner += seconds
+
+    def timed_reader(self, fp, phase='read'):
+        return _TimedReader(fp, self, phase)
+
+    def timed_iter(self, iterable, phase='decode'):
+        "Yields from `iterable`, counting time spent in it as `phase`"
+        it = iter(iterable)
+        times = self.times
+        while True:
+            inner, t0 = self._inner, default_timer()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            own = default_timer() - t0 - (self._inner - inner)
+            times[phase] += own
+            self._inner += own
+            yield item
+
+
+class _TimedReader(object):
+
+    def __init__(self, fp, stats, phase):
+        self._fp = fp
+        self._stats = stats
+        self._phase = phase
+
+    def read(self, size=-1):
+        t0 = default_timer()
+        data = self._fp.read(size)
+        self._stats.add(self._phase, default_timer() - t0)
+        self._stats.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
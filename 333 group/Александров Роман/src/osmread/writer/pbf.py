@@ -0,0 +1,179 @@
+from struct import pack
+import zlib
+import sys
+
+from osmread.elements import Node, Way, Relation, ELEMENT_TYPES
+if sys.version_info > (3,):
+    from osmread.protobuf.fileformat_pb2 import BlobHeader, Blob
+    from osmread.protobuf.osmformat_pb2 import HeaderBlock, PrimitiveBlock
+else:
+    from osmread.protobuf.osm_pb2 import BlobHeader, Blob, HeaderBlock, PrimitiveBlock
+
+_MEMBER_TYPES = {Node: 0, Way: 1, Relation: 2}
+
+# Coordinates are stored in units of 100 nanodegrees (7 decimal digits, as
+# in .osm files) and timestamps in seconds
+GRANULARITY = 100
+DATE_GRANULARITY = 1000
+
+
+def _deltas(values):
+    prev = 0
+    for v in values:
+        yield v - prev
+        prev = v
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        # string 0 is the empty placeholder (and the keys_vals delimiter of
+        # DenseNodes), a real '' gets an id of its own
+        self._ids = {}
+        self.strings = ['']
+
+    def __call__(self, s):
+        sid = self._ids.get(s)
+        if sid is None:
+            sid = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+        return sid
+
+
+class PbfWriter(object):
+    """
+    Writes elements into a .pbf file: nodes as DenseNodes, delta-coded way
+    refs and relation members, zlib-compressed blobs. Elements of one type
+    are gathered into blocks of up to `block_size`; the type should change
+    as rarely as possible (nodes, then ways, then relations), since every
+    change starts a new block. Metadata is written for elements that have
+    it, so compact elements produce a file without metadata.
+    """
+
+    def __init__(self, fp, block_size=8000, compress_level=6):
+        self._fp = fp
+        self._block_size = block_size
+        self._compress_level = compress_level
+        self._type = None
+        self._elements = []
+
+        header = HeaderBlock()
+        header.required_features.extend(('OsmSchema-V0.6', 'DenseNodes'))
+        header.writingprogram = 'osmread'
+        self.__write_blob('OSMHeader', header.SerializeToString())
+
+    def write(self, element):
+        element_type = ELEMENT_TYPES[type(element)]
+        if element_type is not self._type \
+                or len(self._elements) >= self._block_size:
+            self.flush()
+            self._type = element_type
+        self._elements.append(element)
+
+    def flush(self):
+        if not self._elements:
+            return
+
+        pblock = PrimitiveBlock()
+        pblock.granularity = GRANULARITY
+        pblock.date_granularity = DATE_GRANULARITY
+        strings = _StringTable()
+        group = pblock.primitivegroup.add()
+
+        if self._type is Node:
+            self.__write_dense(group.dense, strings)
+        elif self._type is Way:
+            self.__write_ways(group.ways, strings)
+        else:
+            self.__write_relations(group.relations, strings)
+
+        pblock.stringtable.s.extend(s.encode('utf-8') for s in strings.strings)
+        self.__write_blob('OSMData', pblock.SerializeToString())
+        self._elements = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+
+    def __write_blob(self, blob_type, data):
+        blob = Blob()
+        blob.raw_size = len(data)
+        blob.zlib_data = zlib.compress(data, self._compress_level)
+        blob_data = blob.SerializeToString()
+
+        blob_header = BlobHeader()
+        blob_header.type = blob_type
+        blob_header.datasize = len(blob_data)
+        header_data = blob_header.SerializeToString()
+
+        self._fp.write(pack('!L', len(header_data)))
+        self._fp.write(header_data)
+        self._fp.write(blob_data)
+
+    def __write_info(self, info, e):
+        info.version = e.version
+        info.timestamp = e.timestamp
+        info.changeset = e.changeset
+        info.uid = e.uid
+
+    def __write_tags(self, msg, tags, strings):
+        for k, v in tags.items():
+            msg.keys.append(strings(k))
+            msg.vals.append(strings(v))
+
+    def __write_dense(self, dense, strings):
+        nodes = self._elements
+
+        dense.id.extend(_deltas(n.id for n in nodes))
+        dense.lat.extend(_deltas(int(round(n.lat * 1e7)) for n in nodes))
+        dense.lon.extend(_deltas(int(round(n.lon * 1e7)) for n in nodes))
+
+        if any(n.tags for n in nodes):
+            keys_vals = dense.keys_vals
+            for n in nodes:
+                for k, v in n.tags.items():
+                    keys_vals.append(strings(k))
+                    keys_vals.append(strings(v))
+                keys_vals.append(0)
+
+        if all(n.version is not None for n in nodes):
+            info = dense.denseinfo
+            info.version.extend(n.version for n in nodes)
+            info.timestamp.extend(_deltas(n.timestamp for n in nodes))
+            info.changeset.extend(_deltas(n.changeset for n in nodes))
+            info.uid.extend(_deltas(n.uid for n in nodes))
+            info.user_sid.extend(0 for n in nodes)
+
+    def __write_ways(self, ways, strings):
+        for e in self._elements:
+            way = ways.add()
+            way.id = e.id
+            self.__write_tags(way, e.tags, strings)
+            way.refs.extend(_deltas(e.nodes))
+            if e.version is not None:
+                self.__write_info(way.info, e)
+
+    def __write_relations(self, relations, strings):
+        for e in self._elements:
+            relation = relations.add()
+            relation.id = e.id
+            self.__write_tags(relation, e.tags, strings)
+            relation.roles_sid.extend(strings(m.role) for m in e.members)
+            relation.memids.extend(_deltas(m.member_id for m in e.members))
+            relation.types.extend(_MEMBER_TYPES[m.type] for m in e.members)
+            if e.version is not None:
+                self.__write_info(relation.info, e)
+
+
+def write_file(filename, elements, **kwargs):
+    "Writes an iterable of elements into a .pbf file"
+    with open(filename, 'wb') as fp:
+        with PbfWriter(fp, **kwargs) as writer:
+            for e in elements:
+                writer.write(e)
@@ -3,11 +3,6 @@ from functools import lru_cache
 from itertools import tee
 import os.path
 
-from pyx import color, path, style, text, unit
-from pyx.canvas import canvas, clip
-from transliterate import translit
-from utm import from_latlon
-
 from miscellaneous import pairwise
 
 FOLDER_NAME = 'output'
@@ -43,19 +38,26 @@ def write_adj_matrix(adj_list, filename='adj_matrix.csv'):
         for nd, adj in adj_list.items():
             f.write(str(nd)+''.join(',1' if adj_nd in adj else ',0' for adj_nd in adj_list)+'\n')
 
-unit.set(uscale=0.002)
+@lru_cache(maxsize=None)
+def _pyx():
+    "pyx is only needed to draw, so it is imported (and set up) on first use"
+    import pyx.canvas, pyx.color, pyx.path, pyx.style, pyx.text, pyx.unit
+    pyx.unit.set(uscale=0.002)
+    return pyx
 
 _hw_omit = {'service', 'footway', 'track', 'path', 'steps', 'pedestrian', 'construction', 'proposed', 'bus_stop', 'cycleway'}
 _hw_important = {'trunk', 'primary', 'secondary', 'tertiary', 'primary_link','highlight'}
-_clr_important = color.rgbfromhexstring('#200000')
+_clr_important = '#200000'
 
 def _road_linestyle(kind, lanes):
+    style, color = _pyx().style, _pyx().color
     if kind in _hw_important:
-        return [style.linewidth((int(lanes)+1)*8), _clr_important]
+        return [style.linewidth((int(lanes)+1)*8), color.rgbfromhexstring(_clr_important)]
     else:
         return [style.linewidth((int(lanes)+1)*4)]
 
 def linspace_colors(n):
+    color = _pyx().color
     return [color.hsb(0.85*i/(n-1), 1, 0.85) for i in range(n)] if n > 1 else (color.hsb(0, 1, 0.85),)
 
 def make_style(color=None, kind=None, lanes=None):
@@ -66,38 +68,55 @@ def make_style(color=None, kind=None, lanes=None):
     '''
     if kind:
         if kind in _hw_important:
-            color = color or _clr_important
+            color = color or _pyx().color.rgbfromhexstring(_clr_important)
             lanes = lanes * 2 if lanes else 10
-        lanes = style.linewidth((int(lanes)+1)*5)
+        lanes = _pyx().style.linewidth((int(lanes)+1)*5)
 
     return list(filter(None,[color, lanes]))
 
 Rect = namedtuple('Rect', ['right', 'top', 'left', 'bottom'])
 
-if True: # marker for Cheboksary. TODO: make it another way
-    bounds_ll = Rect(47.6023, 56.1966, 46.9347, 56.0061)
-    bounds = Rect(*from_latlon(bounds_ll.top, bounds_ll.right)[:2],
-                  *from_latlon(bounds_ll.bottom, bounds_ll.left)[:2])
-    clip_box = path.rect(x=bounds.left, y=bounds.bottom,
-                         width=bounds.right - bounds.left, height=bounds.top - bounds.bottom)
+def set_bounds(right, top, left, bottom):
+    "Sets the area (in degrees) drawn by `build_map` and used for random points"
+    global bounds_ll
+    bounds_ll = Rect(right, top, left, bottom)
+
+set_bounds(47.6023, 56.1966, 46.9347, 56.0061) # Cheboksary
+
+def get_bounds():
+    "The area set by `set_bounds` in UTM coordinates"
+    return _utm_rect(bounds_ll)
+
+@lru_cache(maxsize=4)
+def _utm_rect(rect):
+    from utm import from_latlon
+    return Rect(*from_latlon(rect.top, rect.right)[:2], *from_latlon(rect.bottom, rect.left)[:2])
 
 @lru_cache(maxsize=16, typed=True)
 def _safer_text(txt):
+    from transliterate import translit
     return translit(txt, 'ru', reversed=True).encode("ascii", errors="ignore").decode()
 
 
 def build_map(nodes, ways, filename='map.pdf', full=True, highlight_ways=None, highlight_nodes=[], comments=None):
     '''
     Draws a map to a pdf/eps/svg file. Arguments:
-    `nodes` - dict of dicts with `x` and `y` keys,
+    `nodes` - NodeStore or dict of dicts with `x` and `y` keys,
     `ways` - a list of `osm.Way` objects,
     `full` - helps to draw a light version of map without pedestrian paths,
     `highlight` - an iterable of node ids or lists of them to draw it highlighted
     '''
     # 1. Setting up a context
-    _replace_with_xy = lambda n_id: (nodes[n_id]['x'], nodes[n_id]['y'])
+    path, text = _pyx().path, _pyx().text
+    if hasattr(nodes, 'table'):
+        _replace_with_xy = nodes.table(('x', 'y')).__getitem__
+    else:
+        _replace_with_xy = lambda n_id: (nodes[n_id]['x'], nodes[n_id]['y'])
 
-    canv = canvas([clip(clip_box)]) if clip_box else canvas()
+    bounds = get_bounds()
+    clip_box = path.rect(x=bounds.left, y=bounds.bottom,
+                         width=bounds.right - bounds.left, height=bounds.top - bounds.bottom)
+    canv = _pyx().canvas.canvas([_pyx().canvas.clip(clip_box)])
     
     # 2. Drawing roads
     for ww in ways if full else filter(lambda ww: ww.tags['highway'] not in _hw_omit, ways):
@@ -120,7 +139,7 @@ def build_map(nodes, ways, filename='map.pdf', full=True, highlight_ways=None, h
             canv.text(x - 60, y - 50, str(i))
 
 
-    _style = [color.hsb(0.2, 1, 0.75)]
+    _style = [_pyx().color.hsb(0.2, 1, 0.75)]
     for elem in highlight_nodes:
         if isinstance(elem, list):
             _style = elem
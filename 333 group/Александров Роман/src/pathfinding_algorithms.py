@@ -1,40 +1,160 @@
 from collections import OrderedDict, defaultdict, namedtuple
 from functools import lru_cache
 from heapq import heappop, heappush
-from itertools import chain
+from itertools import count
 from math import inf, sqrt
 from operator import itemgetter
 
-from sortedcontainers import SortedSet as btree_pqueue
-
 from miscellaneous import timed
+from priority_queues import make_queue
+
+# Queues the searches take unless told otherwise, see priority_queues
+DIJKSTRA_QUEUE, LEVIT_QUEUE, ASTAR_QUEUE = 'heapq', 'fifo', 'heapq'
+
+def restore_path(tup):
+    "(v, (u, (..., ()))) -> (..., u, v)"
+    path = []
+    while tup:
+        path.append(tup[0])
+        tup = tup[1]
+    return tuple(reversed(path))
 
-restore_path = lambda tup: (*restore_path(tup[1]),tup[0]) if tup else ()
 Path = namedtuple('Path', ['cost', 'path'])
 
+# `gr` may be a CSRGraph instead of a dict
+_is_csr = lambda gr: hasattr(gr, 'indptr')
+
+
+def _csr_states(gr, restrictions):
+    '''
+    Search states over CSRGraph `gr`: state i < n is node i, the states of
+    via nodes (node, previous node) are numbered from n on as they are met,
+    `node[s - n]` being the node of such a state s. Returns `restrictions`
+    over the indices, their via nodes, flat `dist` and `prev` lists over
+    the states, `node` and `state(v, u)`, the state of via node `v`
+    entered from `u`.
+    '''
+    local = gr.local_restrictions(restrictions) if restrictions else None
+    vias = local.vias if local else ()
+    dist, prev, node = [inf] * len(gr), [-1] * len(gr), []
+    extra = {}
+
+    def state(v, u):
+        s = extra.get((v, u))
+        if s is None:
+            s = extra[v, u] = len(dist)
+            dist.append(inf)
+            prev.append(-1)
+            node.append(v)
+        return s
+
+    return local, vias, dist, prev, node, state
+
+
+def _csr_node(s, n, node):
+    "Node of state `s`, None for -1"
+    return None if s == -1 else s if s < n else node[s - n]
+
+
+def _csr_path(gr, prev, node, s):
+    "Node ids along the states leading to `s`"
+    n, ids, path = len(gr), gr.views()[3], []
+    while s != -1:
+        path.append(ids[s if s < n else node[s - n]])
+        s = prev[s]
+    return tuple(reversed(path))
+
+
+def _csr_result(gr, ends, dist, prev, node):
+    "{ end: Path } of the reachable `ends` by their best states"
+    n, ends = len(gr), list(ends)
+    best = {}
+    for s, v in enumerate(node, n):
+        if dist[s] < dist[best.get(v, v)]:
+            best[v] = s
+    ans = OrderedDict()
+    for end, i in zip(ends, gr.find_all(ends)):
+        s = best.get(i, i)
+        if i != -1 and dist[s] < inf:
+            ans[end] = Path(cost=dist[s], path=_csr_path(gr, prev, node, s))
+    return ans
+
+
+def _dijkstra_csr(gr, start, ends, restrictions, queue):
+    indptr, indices, weights, _ = gr.views()
+    local, vias, dist, prev, node, state = _csr_states(gr, restrictions)
+    n, ends = len(gr), list(ends)
+    s0 = gr.find(start)
+    if s0 is None:
+        return OrderedDict((end, Path(cost=0, path=(start,))) for end in ends if end == start)
+    if s0 in vias:
+        s0 = state(s0, None)
+    dist[s0] = 0
+    q = make_queue(queue, priority=True)
+    q.push(s0, 0)
+    targets = gr.find_all(ends)
+    left, settled = set(targets) - {-1}, {}
+
+    while q and left:
+        cost, s = q.pop()
+        u = s if s < n else node[s - n]
+        # the first state of a node to be settled is its best one
+        if u in left:
+            left.discard(u)
+            settled[u] = s
+        banned = local.banned(_csr_node(prev[s], n, node), u) if u in vias else ()
+        for k in range(indptr[u], indptr[u+1]):
+            v, c = indices[k], weights[k]
+            if v in banned:
+                continue
+            t = state(v, u) if v in vias else v
+            if cost + c < dist[t]:
+                dist[t], prev[t] = cost + c, s
+                q.push(t, cost + c)
+
+    return OrderedDict((end, Path(cost=dist[settled[i]], path=_csr_path(gr, prev, node, settled[i])))
+                       for end, i in zip(ends, targets) if i in settled)
+
+
 @timed
-def dijkstra(gr, start, ends):
+def dijkstra(gr, start, ends, restrictions=None, queue=DIJKSTRA_QUEUE):
     '''
-    `gr` is a `dict` { u:(v, cost) | (u,v) ∈ E }
+    `gr` is a `dict` { u:(v, cost) | (u,v) ∈ E } or a `CSRGraph`
     `f` is first vertex
     `t` is terminal
-    returns: cost, path
+    `restrictions` is a `TurnRestrictions` index to honor
+    `queue` is the name of the priority queue to use, see priority_queues
+    Stops as soon as all of `ends` are reached.
+    returns: { end: Path(cost, path) } for the reachable `ends`
     '''
-    q, seen = [(0,start,())], set()
+    if _is_csr(gr):
+        return _dijkstra_csr(gr, start, ends, restrictions, queue)
+    vias = restrictions.vias if restrictions else ()
+    # at via nodes the state includes the previous node
+    start = (start, None) if start in vias else start
+    dist, prev = {start: 0}, {start: None}
     ans = OrderedDict.fromkeys(ends)
+    left = set(ans)
+    q = make_queue(queue, priority=True)
+    q.push(start, 0)
 
-    while q:
-        cost, v1, path = heappop(q)
-        if v1 not in seen:
-            seen.add(v1)
-            path = (v1, path)
-
-            if v1 in ans and not ans[v1]:
-                ans[v1] = Path(cost=cost, path=restore_path(path))
+    while q and left:
+        cost, u = q.pop()
+        u_node = _node_of(u)
+        # the first state of a node to be settled is its best one
+        if u_node in left:
+            left.discard(u_node)
+            ans[u_node] = Path(cost=cost, path=_restore(prev, u))
 
-            for v2, c in gr.get(v1, ()):
-                if v2 not in seen:
-                    heappush(q, (cost+c, v2, path))
+        banned = restrictions.banned(_node_of(prev[u]) if prev[u] is not None else None, u_node) \
+            if u_node in vias else ()
+        for v_node, c in gr.get(u_node, ()):
+            if v_node in banned:
+                continue
+            v = (v_node, u_node) if v_node in vias else v_node
+            if cost + c < dist.get(v, inf):
+                dist[v], prev[v] = cost + c, u
+                q.push(v, cost + c)
 
     return OrderedDict(filter(itemgetter(1), ans.items()))
 
@@ -50,89 +170,321 @@ class IndexedQueue(OrderedDict):
 # Same as `lambda: math.inf`, but doesn't break pickling for multiprocessing
 def infinity(): return inf
 
+# Search state of a node: (node, previous node) at via nodes of restrictions
+_node_of = lambda state: state[0] if type(state) is tuple else state
+
+def _restore(prev, state):
+    "Nodes along the predecessor map `prev` up to `state`"
+    path = []
+    while state is not None:
+        path.append(_node_of(state))
+        state = prev[state]
+    return tuple(reversed(path))
+
+def _levit_csr(gr, start, ends, restrictions, queue):
+    indptr, indices, weights, _ = gr.views()
+    local, vias, dist, prev, node, state = _csr_states(gr, restrictions)
+    n = len(gr)
+    s0 = gr.find(start)
+    if s0 is None:
+        return OrderedDict((end, Path(cost=0, path=(start,))) for end in ends if end == start)
+    if s0 in vias:
+        s0 = state(s0, None)
+    dist[s0] = 0
+    m0 = set()
+    m1, m1_urg = make_queue(queue), make_queue(queue)
+    m1.push(s0, 0)
+
+    while m1 or m1_urg:
+        _, s = m1_urg.pop() if m1_urg else m1.pop()
+        u, cost = s if s < n else node[s - n], dist[s]
+        banned = local.banned(_csr_node(prev[s], n, node), u) if u in vias else ()
+        for k in range(indptr[u], indptr[u+1]):
+            v, c = indices[k], weights[k]
+            if v in banned:
+                continue
+            t = state(v, u) if v in vias else v
+            if cost + c >= dist[t]:
+                continue
+            dist[t], prev[t] = cost + c, s
+            # settled states (M0) are urgent, unreached ones (M2) join M1
+            if t in m0:
+                m0.discard(t)
+                m1_urg.push(t, cost + c)
+            elif t in m1_urg:
+                m1_urg.push(t, cost + c)
+            else:
+                m1.push(t, cost + c)
+        m0.add(s)
+
+    return _csr_result(gr, ends, dist, prev, node)
+
+
 @timed
-def levit(gr, start, ends):
+def levit(gr, start, ends, restrictions=None, queue=LEVIT_QUEUE):
     '''
     An algorithm for finding the shortest path from one `start` node to all another.
-    `gr` is an adjancety list { u:[(v, cost), ...] | (u,v) ∈ E },
+    `gr` is an adjancety list { u:[(v, cost), ...] | (u,v) ∈ E } or a `CSRGraph`,
     `ends` are the desired target nodes, though all graph is processed anyway.
+    `restrictions` is a `TurnRestrictions` index to honor.
+    `queue` names the kind of the M1 queues, see priority_queues: FIFO as
+    Levit has it or a priority queue by distance.
     Returns a dict like { node: Path(cost, path) }
     '''
+    if _is_csr(gr):
+        return _levit_csr(gr, start, ends, restrictions, queue)
+    vias = restrictions.vias if restrictions else ()
+    start = (start, None) if start in vias else start
     dist = defaultdict(infinity)
     dist[start] = 0
-    path = {start:(start,())}
+    path = {start:(_node_of(start),())}
     m0 = set()
-    m1, m1_urg = IndexedQueue.fromkeys([start]), IndexedQueue()
-    m2 = set(chain.from_iterable((v for v, _ in from_u) for from_u in gr.values())) - {start}
-    
+    m1, m1_urg = make_queue(queue), make_queue(queue)
+    m1.push(start, 0)
+
     def relax(u, v, w):
         if (dist[v] > dist[u] + w):
             dist[v] = dist[u] + w
-            path[v] = (v, path[u])
+            path[v] = (_node_of(v), path[u])
             return True
         return False
 
     while m1 or m1_urg:
-        u = m1_urg.pop() if m1_urg else m1.pop()
-        for v, c in gr.get(u, ()):
-            if v in m2:
-                m1.push(v)
-                m2.discard(v)
-                relax(u, v, c)
-            elif v in m1:
+        _, u = m1_urg.pop() if m1_urg else m1.pop()
+        u_node = _node_of(u)
+        banned = restrictions.banned(u[1], u_node) if u_node in vias else ()
+        for v, c in gr.get(u_node, ()):
+            if v in banned:
+                continue
+            if v in vias:
+                v = (v, u_node)
+            # states never reached form the set M2
+            if v not in path:
                 relax(u, v, c)
+                m1.push(v, dist[v])
+            elif v in m1 or v in m1_urg:
+                if relax(u, v, c):
+                    (m1 if v in m1 else m1_urg).push(v, dist[v])
             elif v in m0 and relax(u, v, c):
-                m1_urg.push(v)
+                m1_urg.push(v, dist[v])
                 m0.discard(v)
         m0.add(u)
 
-    return OrderedDict((v, Path(cost=dist[v], path=restore_path(path[v]))) for v in ends if v in path)                
+    best = {}
+    for state, cost in dist.items():
+        v = _node_of(state)
+        if cost < best.get(v, (inf,))[0]:
+            best[v] = (cost, state)
+    return OrderedDict((v, Path(cost=best[v][0], path=restore_path(path[best[v][1]]))) for v in ends if v in best)
 
 
 estim = namedtuple('estim', ['heur', 'dist', 'prev'])
 
-def astar(gr, start, end, heur):
-    c = {start: estim(heur=heur(start, end), dist=0, prev=None)}
-    q = btree_pqueue([(c[start].heur, start)])
+def _astar_csr(gr, start, end, heur, restrictions, queue):
+    indptr, indices, weights, ids = gr.views()
+    local, vias, dist, prev, node, state = _csr_states(gr, restrictions)
+    n = len(gr)
+    s0, target = gr.find(start), gr.find(end)
+    if s0 is None or target is None:
+        return Path(0, (start,)) if start == end else Path(inf, None)
+    if s0 in vias:
+        s0 = state(s0, None)
+    dist[s0] = 0
+    q = make_queue(queue, priority=True)
+    q.push(s0, heur(start, end))
+
+    while q:
+        _, s = q.pop()
+        u = s if s < n else node[s - n]
+        if u == target:
+            return Path(dist[s], _csr_path(gr, prev, node, s))
+
+        banned = local.banned(_csr_node(prev[s], n, node), u) if u in vias else ()
+        for k in range(indptr[u], indptr[u+1]):
+            v, w = indices[k], weights[k]
+            if v in banned:
+                continue
+            t = state(v, u) if v in vias else v
+            tent = dist[s] + w
+            if tent < dist[t]:
+                dist[t], prev[t] = tent, s
+                q.push(t, tent + heur(ids[v], end))
+
+    return Path(inf, None)
+
+def astar(gr, start, end, heur, restrictions=None, queue=ASTAR_QUEUE):
+    '''
+    A* from `start` to `end` over `gr`, a dict { u:[(v, cost), ...] } or a
+    `CSRGraph`, with the heuristic `heur(node, end)`.
+    `restrictions` is a `TurnRestrictions` index to honor, `queue` the name
+    of the priority queue to use, see priority_queues.
+    Returns Path(cost, path), Path(inf, None) if `end` can't be reached.
+    '''
+    if _is_csr(gr):
+        return _astar_csr(gr, start, end, heur, restrictions, queue)
+    vias = restrictions.vias if restrictions else ()
+    start = (start, None) if start in vias else start
+    c = {start: estim(heur=heur(_node_of(start), end), dist=0, prev=None)}
+    q = make_queue(queue, priority=True)
+    q.push(start, c[start].heur)
 
     while q:
-        _, u = q.pop(0)
-        if u == end:
+        _, u = q.pop()
+        u_node = _node_of(u)
+        if u_node == end:
             path = [u]
-            while path[-1] is not start:
+            while c[path[-1]].prev is not None:
                 path.append(c[path[-1]].prev)
 
-            return Path(c[u].dist, tuple(reversed(path)))
+            return Path(c[u].dist, tuple(map(_node_of, reversed(path))))
         
-        for v, w in gr.get(u, ()):
+        banned = restrictions.banned(u[1], u_node) if u_node in vias else ()
+        for v_node, w in gr.get(u_node, ()):
+            if v_node in banned:
+                continue
+            v = (v_node, u_node) if v_node in vias else v_node
             tent = c[u].dist + w
             if v not in c or tent < c[v].dist:
-                if v in c:
-                    q.discard((c[v].heur, v))
-                v_heur = tent+heur(v, end)
+                v_heur = tent+heur(v_node, end)
                 c[v] = estim(heur=v_heur, dist=tent, prev=u)
-                q.add((v_heur, v))
+                q.push(v, v_heur)
     
     return Path(inf, None)
 
+def reverse_graph(gr):
+    "{ v:[(u, cost), ...] } for the edges (u, v) of `gr` { u:[(v, cost), ...] }"
+    rev = defaultdict(list)
+    for u, adj in gr.items():
+        for v, c in adj:
+            rev[v].append((u, c))
+    return rev
+
+
+def _csr_edges(gr):
+    "u -> [(v, cost), ...] over CSRGraph `gr`"
+    indptr, indices, weights, _ = gr.views()
+    return lambda u: zip(indices[indptr[u]:indptr[u+1]], weights[indptr[u]:indptr[u+1]])
+
+
+def _bidirectional(forward, backward, start, end, potential, restrictions):
+    '''
+    Searches from `start` along `forward(u)` -> [(v, cost), ...] and from
+    `end` along `backward(v)` -> [(u, cost), ...] at once, returns the cost
+    and the nodes of the shortest path or (inf, None).
+    States at via nodes are (node, previous node) forward and (node, next
+    node) backward; the searches meet at a node if the turn there is
+    allowed. With a `potential` (consistent for both directions) the keys
+    are dist + potential forward and dist - potential backward, and the
+    search stops when the sum of the smallest keys reaches the best path.
+    '''
+    vias = restrictions.vias if restrictions else ()
+    pot = potential or (lambda v: 0)
+    starts = ((start, None) if start in vias else start, (end, None) if end in vias else end)
+    dist = ({starts[0]: 0}, {starts[1]: 0})
+    prev = ({starts[0]: None}, {starts[1]: None})
+    # states of each node reached by each search
+    at = (defaultdict(list), defaultdict(list))
+    at[0][start].append(starts[0])
+    at[1][end].append(starts[1])
+    tie = count()
+    queues = ([(pot(start), next(tie), starts[0])], [(-pot(end), next(tie), starts[1])])
+    done = (set(), set())
+    best, meet = inf, None
+
+    def turn_ok(node, fwd, bwd):
+        "Whether the path ending with the state `fwd` can go on with `bwd`"
+        return node not in vias or bwd[1] is None or bwd[1] not in restrictions.banned(fwd[1], node)
+
+    if start == end:
+        return 0, (start,)
+
+    while queues[0] and queues[1] and queues[0][0][0] + queues[1][0][0] < best:
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        _, _, u = heappop(queues[side])
+        if u in done[side]:
+            continue
+        done[side].add(u)
+        u_node, cost = _node_of(u), dist[side][u]
+
+        if side == 0:
+            banned = restrictions.banned(u[1], u_node) if u_node in vias else ()
+            edges = forward(u_node)
+        else:
+            banned = ()
+            edges = backward(u_node)
+        for v_node, c in edges:
+            if side == 0 and v_node in banned:
+                continue
+            # backward the turn at `u_node` is checked when its previous node is known
+            if side == 1 and u_node in vias and u[1] is not None and \
+                    u[1] in restrictions.banned(v_node, u_node):
+                continue
+            v = (v_node, u_node) if v_node in vias else v_node
+            if cost + c < dist[side].get(v, inf):
+                if v not in dist[side]:
+                    at[side][v_node].append(v)
+                dist[side][v], prev[side][v] = cost + c, u
+                heappush(queues[side], (cost + c + (pot(v_node) if side == 0 else -pot(v_node)), next(tie), v))
+                for w in at[1 - side].get(v_node, ()):
+                    fwd, bwd = (v, w) if side == 0 else (w, v)
+                    if cost + c + dist[1 - side][w] < best and turn_ok(v_node, fwd, bwd):
+                        best, meet = cost + c + dist[1 - side][w], (fwd, bwd)
+
+    if meet is None:
+        return inf, None
+    return best, _restore(prev[0], meet[0]) + tuple(reversed(_restore(prev[1], meet[1])))[1:]
+
+
+def bidirectional(gr, start, end, heur=None, restrictions=None, reverse=None):
+    '''
+    Point-to-point search from both ends: Dijkstra or, with `heur`, A* with
+    the average of the forward and backward heuristics as the potential.
+    `gr` is a dict { u:[(v, cost), ...] } or a CSRGraph, `reverse` is
+    `reverse_graph(gr)` for a dict (built on every call if not given; a
+    CSRGraph keeps its own).
+    `restrictions` is a `TurnRestrictions` index to honor.
+    Returns Path(cost, path) like `astar`.
+    '''
+    if _is_csr(gr):
+        local = gr.local_restrictions(restrictions) if restrictions else None
+        s0, t0 = gr.find(start), gr.find(end)
+        if s0 is None or t0 is None:
+            return Path(0, (start,)) if start == end else Path(inf, None)
+        ids = gr.views()[3]
+        potential = heur and (lambda v: (heur(ids[v], end) - heur(start, ids[v])) / 2)
+        cost, path = _bidirectional(_csr_edges(gr), _csr_edges(gr.reverse()), s0, t0, potential, local)
+        return Path(cost, path and tuple(ids[v] for v in path))
+
+    reverse = reverse if reverse is not None else reverse_graph(gr)
+    potential = heur and (lambda v: (heur(v, end) - heur(start, v)) / 2)
+    cost, path = _bidirectional(lambda u: gr.get(u, ()), lambda v: reverse.get(v, ()),
+                                start, end, potential, restrictions)
+    return Path(cost, path)
+
+
 def set_context(node_coords):
-    global nodes
-    nodes = node_coords
+    "Makes the heuristics use the coordinates of `node_coords`, a NodeStore or { id: node dict }"
+    global coords
+    coords = node_coords.table(('lat', 'lon')) if hasattr(node_coords, 'table') else \
+        {nd_id: (nd['lat'], nd['lon']) for nd_id, nd in node_coords.items()}
+    # ids of points may be reused with other coordinates
+    for heur in (dist_manh, dist_euc, dist_cheb):
+        heur.cache_clear()
 
 @lru_cache(maxsize=None, typed=True)
 def dist_manh(id1, id2):
-    return 0.55 * (abs(nodes[id1]['lat'] - nodes[id2]['lat']) * 3540 +
-                  abs(nodes[id1]['lon'] - nodes[id2]['lon']) * 6364)
+    (lat1, lon1), (lat2, lon2) = coords[id1], coords[id2]
+    return 0.55 * (abs(lat1 - lat2) * 3540 + abs(lon1 - lon2) * 6364)
 
 @lru_cache(maxsize=None, typed=True)
 def dist_euc(id1, id2):
-    return 0.55 * sqrt(((nodes[id1]['lat'] - nodes[id2]['lat']) * 3540) ** 2 +
-                       ((nodes[id1]['lon'] - nodes[id2]['lon']) * 6364) ** 2)
+    (lat1, lon1), (lat2, lon2) = coords[id1], coords[id2]
+    return 0.55 * sqrt(((lat1 - lat2) * 3540) ** 2 + ((lon1 - lon2) * 6364) ** 2)
 
 @lru_cache(maxsize=None, typed=True)
 def dist_cheb(id1, id2):
-    return 0.55 * max(abs(nodes[id1]['lat'] - nodes[id2]['lat']) * 3540,
-               abs(nodes[id1]['lon'] - nodes[id2]['lon']) * 6364)
+    (lat1, lon1), (lat2, lon2) = coords[id1], coords[id2]
+    return 0.55 * max(abs(lat1 - lat2) * 3540, abs(lon1 - lon2) * 6364)
 
 
 @timed
@@ -147,4 +499,35 @@ def astar_euc(*args, **kwargs):
 def astar_cheb(*args, **kwargs):
     return astar(*args, heur=dist_cheb, **kwargs)
 
+@timed
+def astar_alt(gr, start, end, **kwargs):
+    "A* with the landmarks of `gr`, built on the first call for it"
+    from landmarks import use_landmarks
+    return astar(gr, start, end, heur=use_landmarks(gr), **kwargs)
+
+@timed
+def bidijkstra(*args, **kwargs):
+    return bidirectional(*args, **kwargs)
+
+@timed
+def biastar_manh(*args, **kwargs):
+    return bidirectional(*args, heur=dist_manh, **kwargs)
+
+@timed
+def biastar_euc(*args, **kwargs):
+    return bidirectional(*args, heur=dist_euc, **kwargs)
+
+@timed
+def biastar_cheb(*args, **kwargs):
+    return bidirectional(*args, heur=dist_cheb, **kwargs)
+
+@timed
+def ch_search(gr, start, end, restrictions=None):
+    "Contraction hierarchy query, the hierarchy is built on the first call for `gr`"
+    from contraction_hierarchy import use_hierarchy
+    return use_hierarchy(gr, restrictions).query(start, end)
+
 
+# The searches that take a `queue`, by the one they use by default
+QUEUED = {dijkstra: DIJKSTRA_QUEUE, levit: LEVIT_QUEUE, astar_manh: ASTAR_QUEUE,
+          astar_euc: ASTAR_QUEUE, astar_cheb: ASTAR_QUEUE, astar_alt: ASTAR_QUEUE}
@@ -0,0 +1,204 @@
+'''
+Queues of search states for pathfinding_algorithms.
+
+All of them share one interface: `push(item, key)` queues `item` or changes
+the key of a queued one, `pop()` takes the item with the least key out and
+returns (key, item), `item in queue` and `len(queue)` are the usual. An
+item popped can be pushed again. `make_queue(name)` makes one of QUEUES:
+
+* `heapq` - binary heap with lazy deletion: a changed key is pushed anew
+  and the old entry is skipped when it comes up
+* `indexed` - binary heap with the positions of the items, a changed key
+  moves its item in place (real decrease-key), no stale entries
+* `radix` - radix heap for keys that don't go below the last popped one
+  (Dijkstra, A* with a consistent heuristic)
+* `fifo` - not a priority queue: items in the order they were first pushed,
+  as Levit's algorithm takes them
+'''
+from collections import OrderedDict
+from heapq import heappop, heappush
+from itertools import count
+from math import inf
+
+
+class LazyHeap(object):
+    name, priority = 'heapq', True
+
+    def __init__(self):
+        self._heap, self._keys = [], {}
+        # breaks ties, so items are never compared
+        self._tie = count()
+
+    def push(self, item, key):
+        if self._keys.get(item) != key:
+            self._keys[item] = key
+            heappush(self._heap, (key, next(self._tie), item))
+
+    def pop(self):
+        heap, keys = self._heap, self._keys
+        while True:
+            key, _, item = heappop(heap)
+            # entries of popped items and old keys are stale
+            if keys.get(item) == key:
+                del keys[item]
+                return key, item
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class IndexedHeap(object):
+    name, priority = 'indexed', True
+
+    def __init__(self):
+        # entries are (key, push number): equal keys come out in the order
+        # they were pushed, as from the other heaps; A* with landmarks has
+        # a lot of them
+        self._entries, self._items, self._pos = [], [], {}
+        self._tie = count()
+
+    def push(self, item, key):
+        i = self._pos.get(item)
+        if i is None:
+            self._entries.append((key, next(self._tie)))
+            self._items.append(item)
+            self._up(len(self._items) - 1)
+        elif key < self._entries[i][0]:
+            self._entries[i] = (key, next(self._tie))
+            self._up(i)
+        elif key > self._entries[i][0]:
+            self._entries[i] = (key, next(self._tie))
+            self._down(i)
+
+    def pop(self):
+        entries, items = self._entries, self._items
+        (key, _), item = entries[0], items[0]
+        del self._pos[item]
+        last_entry, last_item = entries.pop(), items.pop()
+        if items:
+            entries[0], items[0] = last_entry, last_item
+            self._down(0)
+        return key, item
+
+    def _up(self, i):
+        entries, items, pos = self._entries, self._items, self._pos
+        entry, item = entries[i], items[i]
+        while i:
+            parent = (i - 1) >> 1
+            if entries[parent] < entry:
+                break
+            entries[i], items[i] = entries[parent], items[parent]
+            pos[items[i]] = i
+            i = parent
+        entries[i], items[i] = entry, item
+        pos[item] = i
+
+    def _down(self, i):
+        entries, items, pos = self._entries, self._items, self._pos
+        entry, item, n = entries[i], items[i], len(items)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and entries[child + 1] < entries[child]:
+                child += 1
+            if entry < entries[child]:
+                break
+            entries[i], items[i] = entries[child], items[child]
+            pos[items[i]] = i
+            i = child
+        entries[i], items[i] = entry, item
+        pos[item] = i
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RadixQueue(object):
+    '''
+    Radix heap: a key k goes to bucket `bit_length(int(k * scale) ^ last)`,
+    `last` being the last popped key as an integer, so keys near it go to
+    the low buckets and a pop only spreads the first nonempty bucket over
+    the lower ones. Bucket 0 is a heap of exact keys, so the order is
+    exact whatever `scale` is; keys below `last` (inconsistent heuristics,
+    Levit's queues) go there too. Changed keys are lazily deleted.
+    '''
+    name, priority = 'radix', True
+    # integer keys are clipped to 63 bits, inf is above them all
+    _MAX = (1 << 63) - 1
+
+    def __init__(self, scale=1000):
+        self.scale = scale
+        self._last = 0
+        self._buckets = [[] for _ in range(65)]
+        self._keys = {}
+        self._tie = count()
+
+    def _int(self, key):
+        return min(int(key * self.scale), self._MAX - 1) if key < inf else self._MAX
+
+    def _put(self, item, key):
+        k = self._int(key)
+        if k <= self._last:
+            heappush(self._buckets[0], (key, next(self._tie), item))
+        else:
+            self._buckets[(k ^ self._last).bit_length()].append((key, item))
+
+    def push(self, item, key):
+        if self._keys.get(item) != key:
+            self._keys[item] = key
+            self._put(item, key)
+
+    def pop(self):
+        buckets, keys = self._buckets, self._keys
+        if not keys:
+            raise IndexError('pop from an empty queue')
+        while True:
+            while buckets[0]:
+                key, _, item = heappop(buckets[0])
+                if keys.get(item) == key:
+                    del keys[item]
+                    return key, item
+            i = next(i for i, bucket in enumerate(buckets) if bucket)
+            entries = [(key, item) for key, item in buckets[i] if keys.get(item) == key]
+            buckets[i] = []
+            if entries:
+                self._last = min(self._int(key) for key, _ in entries)
+                for key, item in entries:
+                    self._put(item, key)
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class FifoQueue(OrderedDict):
+    name, priority = 'fifo', False
+
+    def push(self, item, key):
+        # a queued item keeps its place
+        self[item] = key
+
+    def pop(self):
+        item, key = self.popitem(last=False)
+        return key, item
+
+
+QUEUES = OrderedDict((cls.name, cls) for cls in (LazyHeap, IndexedHeap, RadixQueue, FifoQueue))
+
+
+def make_queue(name, priority=False):
+    "A new queue of the kind `name` from QUEUES, one popping the least key first if `priority`"
+    if name not in QUEUES:
+        raise ValueError('Unknown queue {!r}, expected one of {}'.format(name, ', '.join(QUEUES)))
+    if priority and not QUEUES[name].priority:
+        raise ValueError('{!r} is not a priority queue'.format(name))
+    return QUEUES[name]()
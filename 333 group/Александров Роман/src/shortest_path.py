@@ -4,22 +4,34 @@ from math import atan2, cos, inf, radians, sin, sqrt
 from operator import attrgetter, itemgetter
 from random import choice, randrange
 
-import utm
-
-import OSM_Processing as mgr
-from output_mgr import bounds
+import output_mgr
 from miscellaneous import pairwise, timed
 
-adj_list, nodes = defaultdict(set), mgr.nodes
-adj_list.update(mgr.adj_list)
-ways = {way.id:way for way in mgr.ways}
-node_ids = list(mgr.nodes.keys())
+# The road graph the functions below work on, set by `use_graph`
+mgr = nodes = ways = node_ids = None
+adj_list = defaultdict(set)
+
+
+def use_graph(graph):
+    "Makes the module work on `graph` (an OSM_Processing.RoadGraph), returns it"
+    global mgr, nodes, ways, node_ids
+    mgr, nodes, ways = graph, graph.nodes, graph.ways
+    adj_list.clear()
+    adj_list.update(graph.adj_list)
+    # listed on the first `random_nodeid`
+    node_ids = None
+    if graph.bbox is not None:
+        output_mgr.set_bounds(right=graph.bbox.max_lon, top=graph.bbox.max_lat,
+                              left=graph.bbox.min_lon, bottom=graph.bbox.min_lat)
+    return graph
 
 
 def dist_km(nd1, nd2):
     "Haversine distance"
-    lat1, lon1 = nd1['lat'], nd1['lon']
-    lat2, lon2 = nd2['lat'], nd2['lon']
+    return dist_km_coords(nd1['lat'], nd1['lon'], nd2['lat'], nd2['lon'])
+
+def dist_km_coords(lat1, lon1, lat2, lon2):
+    "Haversine distance between two (lat, lon) in radians"
     dlon = lon2 - lon1
     dlat = lat2 - lat1
 
@@ -27,6 +39,13 @@ def dist_km(nd1, nd2):
     # R = 6364 # approx. at Cheboksary
     return 6364 * 2 * atan2(sqrt(a), sqrt(1 - a))
 
+def dist_km_columns(lat1, lon1, lat2, lon2):
+    "`dist_km_coords` over numpy columns"
+    import numpy as np
+
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 6364 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
 dist_km_ids = lambda id1, id2: dist_km(nodes[id1], nodes[id2])
 # dist_euc = lambda nd1, nd2: sqrt((nd1['x']-nd2['x'])**2 + (nd1['y']-nd2['y'])**2)
 # _compose = lambda f, g: lambda *a, **kw: f(g(*a, **kw))
@@ -43,17 +62,24 @@ def get_info(nd_id):
 
 # get_info = lambda nd_id: dict(id=nd_id, **nodes[nd_id])
 def random_nodeid():
+    global node_ids
+    if node_ids is None:
+        node_ids = list(nodes.keys())
     return choice(node_ids)
 
 def random_node():
     return nodes[random_nodeid()]
 
 def make_point_at(x_rel, y_rel):
+    import utm
+    bounds = output_mgr.get_bounds()
     x, y = bounds.left * (1 - x_rel) + bounds.right * x_rel, bounds.bottom * (1 - y_rel) + bounds.top * y_rel
     lat, lon = utm.to_latlon(x, y, 38, 'V')
     return {'x':x, 'y':y, 'lat':radians(lat), 'lon':radians(lon)}
 
 def random_point():
+    import utm
+    bounds = output_mgr.get_bounds()
     x, y = randrange(int(bounds.left), int(bounds.right)), randrange(int(bounds.bottom), int(bounds.top))
     lat, lon = utm.to_latlon(x, y, 38, 'V')
     return {'x':x, 'y':y, 'lat':radians(lat), 'lon':radians(lon)}
@@ -68,20 +94,32 @@ def linspaced_points(x_count, y_count):
 # Calculating weights of edges
 @timed
 def calculate_dists():
-    dists = {}
-    for nd_id, adj in adj_list.items():
-        node1 = get_info(nd_id)
-        dists[nd_id] = [(nd2, dist_km(node1, get_info(nd2))) for nd2 in adj]
+    # the lengths of all the edges at once, over the coordinate columns
+    edges = [(nd1, nd2) for nd1, adj in adj_list.items() for nd2 in adj]
+    dists = {nd_id: [] for nd_id in adj_list}
+    if edges:
+        ends1, ends2 = zip(*edges)
+        lengths = dist_km_columns(*nodes.coords(ends1), *nodes.coords(ends2)).tolist()
+        for (nd1, nd2), length in zip(edges, lengths):
+            dists[nd1].append((nd2, length))
     return dists
 
 # The 2 awkward functions below connect spots with the road system
 def find_nearest_way_connections(destinations):
     "Finds connection with a road, refines adj. list, returns a dict of tuples dest_id:waynode_id"
+    import numpy as np
+
+    nd_ids = np.fromiter(nodes, np.int64, len(nodes))
+    lat, lon = nodes.coords(nd_ids)
+    is_dest = np.isin(nd_ids, list(destinations))
     dest_neighbors = { spot:(None, inf) for spot in destinations }
-    for nd_id, nd in nodes.items():
-        for dest_id, dest in destinations.items():
-            if dist_km(nd, dest) < dest_neighbors[dest_id][1] and nd_id not in destinations:
-                dest_neighbors[dest_id] = (nd_id, dist_km(nd, dest))
+    for dest_id, dest in destinations.items():
+        dists = dist_km_columns(lat, lon, dest['lat'], dest['lon'])
+        dists[is_dest] = inf
+        # the first of the nearest in the order of `nodes`
+        nearest = int(np.argmin(dists)) if len(dists) else 0
+        if len(dists) and dists[nearest] < inf:
+            dest_neighbors[dest_id] = (int(nd_ids[nearest]), float(dists[nearest]))
     
     for spot, neighbor in dest_neighbors.items():
         refine_adj_list(neighbor[0])
@@ -104,6 +142,8 @@ def refine_adj_list(node):
         adj_list[node].update((before, after))
         adj_list[before].add(node)
         adj_list[after].add(node)
+        # the turns at `before` and `after` stay restricted through `node`
+        mgr.restrictions = mgr.restrictions.split(before, after, node)
 
 # The next few functions are used to enhance paths for the full map
 def get_len_of_segment(way, begin, end):
@@ -112,17 +152,19 @@ def get_len_of_segment(way, begin, end):
     if sum(1 for occ in way.nodes if occ == begin or occ == end)!=2:
         pass # whoops
     segm = way.nodes[min(ind1, ind2):max(ind1, ind2)+1]
-    return sum(dist_km(nd1, nd2) for nd1, nd2 in pairwise(map(get_info, segm))), segm
+    coords = nodes.table(('lat', 'lon'))
+    return sum(dist_km_coords(*coords[nd1], *coords[nd2]) for nd1, nd2 in pairwise(segm)), segm
 
-def get_way_ids(nd_id):
-    "Returns a set with the ways that cross `nd_id`"
-    return set(way.id for way in get_info(nd_id).get('ways',[]))
+def get_ways(nd_id):
+    "Returns { id(way): way } of the ways that cross `nd_id`"
+    # Parts of a clipped way share its id, so ways are told apart by identity
+    return {id(way):way for way in nodes.ways.get(nd_id) or []}
 
 def add_intermediate(n1, n2):
     "Returns shortest path across 1 way from n1 (incl.) to n2 (not incl.)"
     if mgr.spots.get(n1) or mgr.spots.get(n2): return [n1]
-    common_ways = list(get_way_ids(n1) & get_way_ids(n2))
-    connections = list(get_len_of_segment(ways[way_id], n1, n2) for way_id in common_ways)
+    ways1, ways2 = get_ways(n1), get_ways(n2)
+    connections = list(get_len_of_segment(way, n1, n2) for key, way in ways1.items() if key in ways2)
     if connections:
         _, path = min(connections)
         return (path if path[0] == n1 else list(reversed(path)))[:-1]
@@ -1,30 +1,54 @@
 # from concurrent.futures import ProcessPoolExecutor as proc_pool
+from functools import partial
 from itertools import islice, product, repeat
 from operator import itemgetter
 import sys
 
-from output_mgr import build_map, make_style, color, write_paths_csv, write_report
+from OSM_Processing import DEFAULT_FILENAME, build_graph
+from output_mgr import build_map, make_style, write_paths_csv, write_report
 import pathfinding_algorithms
-from pathfinding_algorithms import astar, dijkstra, levit, astar_euc, astar_cheb, astar_manh
+from pathfinding_algorithms import astar, dijkstra, levit, astar_euc, astar_cheb, astar_manh, astar_alt, \
+    bidijkstra, biastar_euc, biastar_cheb, biastar_manh, ch_search, QUEUED
+from priority_queues import QUEUES
 from shortest_path import (
-    mgr, nodes, node_ids, bounds,
-    find_nearest_way_connections, expand_path, calculate_dists, random_points, linspaced_points
+    use_graph, find_nearest_way_connections, expand_path, calculate_dists, random_points, linspaced_points
 )
 
-ALL_ALGORITHMS = (astar_manh, astar_euc, astar_cheb, dijkstra, levit)
+ALL_ALGORITHMS = (astar_manh, astar_euc, astar_cheb, astar_alt, dijkstra, levit,
+                  bidijkstra, biastar_manh, biastar_euc, biastar_cheb, ch_search)
+# The road graph, see `init_graph`
+mgr = nodes = None
+
+def init_graph(filename=DEFAULT_FILENAME):
+    global mgr, nodes
+    mgr = use_graph(build_graph(filename))
+    nodes = mgr.nodes
+
+def stats(func, queue=None):
+    "Timing of `func` and the queue it ran with, if it takes one"
+    if func in QUEUED and func.stats():
+        return '{} ({} queue)'.format(func.stats(), queue or QUEUED[func])
+    return func.stats()
+
 # OK, now moving on to usage
-def demonstrate(func, gr, start, ends, task_id='', write_res=True, draw_map=False):
+def demonstrate(func, gr, start, ends, task_id='', write_res=True, draw_map=False, queue=None):
+    options = {'restrictions': mgr.restrictions}
+    if func in QUEUED:
+        options['queue'] = queue or QUEUED[func]
     if write_res:
         label = str(task_id or start[0]) + ' - ' + func.__name__ 
+        if func in QUEUED:
+            label += ' - ' + options['queue']
         print('spawned', label)
     nodes[start[0]] = start[1]
 
     # path finding
     if func is dijkstra or func is levit:
-        cost_paths = islice(func(gr, start[0], ends).values(), 10)
+        cost_paths = islice(func(gr, start[0], ends, **options).values(), 10)
     else:
         pathfinding_algorithms.set_context(nodes)
-        cost_paths = islice(filter(itemgetter(1), map(func, repeat(gr), repeat(start[0]), ends)), 10)
+        search = partial(func, **options)
+        cost_paths = islice(filter(itemgetter(1), map(search, repeat(gr), repeat(start[0]), ends)), 10)
         
     try:
         costs, paths = zip(*cost_paths)
@@ -43,6 +67,7 @@ def demonstrate(func, gr, start, ends, task_id='', write_res=True, draw_map=Fals
         
     
     if draw_map:
+        from pyx import color
         comments = ('{}. {} ({:.1f} km, ~{} mins)'.format(*row) for row in summary)
         build_map(nodes, mgr.ways, filename=label+'.pdf', full=False,
                   highlight_ways=expand_path(paths), highlight_nodes=[make_style(color.gray(1)), start[0]],
@@ -51,23 +76,30 @@ def demonstrate(func, gr, start, ends, task_id='', write_res=True, draw_map=Fals
     # return func.last_run()
 
 
-def run_algorithms(starts, algorithms=ALL_ALGORITHMS, write_res=True, draw_map=False):
+def run_algorithms(starts, algorithms=ALL_ALGORITHMS, write_res=True, draw_map=False, queue=None):
+    from csr_graph import CSRGraph
     global nodes
     nodes.update(starts)
     
     find_nearest_way_connections({**mgr.spots, **starts})
-    dists = calculate_dists()
+    dists = CSRGraph.from_dists(calculate_dists())
     print('Initialized weights in {:.2f} sec.'.format(calculate_dists.last_run()))
+    if ch_search in algorithms:
+        from contraction_hierarchy import use_hierarchy
+        use_hierarchy(dists, mgr.restrictions, directory=mgr.source + '.ch', verbose=True)
+    if astar_alt in algorithms:
+        from landmarks import use_landmarks
+        print('Using', use_landmarks(dists, directory=mgr.source + '.alt'))
 
     dests = sorted(mgr.spots.keys(), key=lambda nd_id: nodes[nd_id]['x'])
 
-    kw = [(f, dists, s[1], dests, s[0], write_res, draw_map) \
+    kw = [(f, dists, s[1], dests, s[0], write_res, draw_map, queue) \
         for f,s in product(algorithms, enumerate(starts.items()))]
 
     list(map(demonstrate, *zip(*kw)))
 
     for fn in algorithms:
-        print(fn.stats())
+        print(stats(fn, queue))
 
     
 
@@ -76,18 +108,34 @@ def demo_ui(start=None):
 
 def demo_linspace():
     run_algorithms(starts=linspaced_points(10, 10), write_res=False, draw_map=False)
-    write_report('benchmark.txt', [fn.stats() for fn in ALL_ALGORITHMS])
+    write_report('benchmark.txt', [stats(fn) for fn in ALL_ALGORITHMS])
 
 
 def demo_astar():
-    astars = (astar_manh, astar_cheb, astar_euc)
+    astars = (astar_manh, astar_cheb, astar_euc, astar_alt)
     run_algorithms(starts=random_points(5), algorithms=astars)
-    write_report('astar heuristics.txt', [fn.stats() for fn in astars])
+    write_report('astar heuristics.txt', [stats(fn) for fn in astars])
+
+def demo_queues():
+    "The searches that take a queue with each of the queues, from the same points"
+    starts, searches, report = random_points(5), (dijkstra, levit, astar_euc, astar_alt), []
+    for queue, kind in QUEUES.items():
+        # Dijkstra and A* need a priority queue, Levit takes any
+        algorithms = [fn for fn in searches if kind.priority or fn is levit]
+        for fn in algorithms:
+            fn.reset()
+        run_algorithms(starts, algorithms=algorithms, write_res=False, queue=queue)
+        report += [stats(fn, queue) for fn in algorithms]
+    write_report('queues.txt', report)
+    # the timings are by queue, later runs shouldn't add to them
+    for fn in searches:
+        fn.reset()
     
 
 ARGV_OPTIONS = '''
 * `benchmark` to compare performance of the algorithms
 * `astar` to compare heuristics for A*
+* `queues` to compare priority queues in the searches
 * ID to find and see the shortest paths from a node chosen by id
 * LAT LON coordinates to do the same by coordinate
 '''
@@ -95,6 +143,7 @@ ARGV_OPTIONS = '''
 if __name__ == '__main__':
     argv = sys.argv
     print(argv)
+    init_graph()
     if len(argv) == 1:
         try:
             print('Choose your option:', ARGV_OPTIONS)
@@ -120,6 +169,8 @@ if __name__ == '__main__':
             demo_linspace()
         elif arg == 'astar':
             demo_astar()
+        elif arg == 'queues':
+            demo_queues()
         elif arg.isdecimal():
             maybe_nodeid = int(arg)
             node = nodes.get(maybe_nodeid)
@@ -4,23 +4,32 @@ from sys import argv
 
 from toolz import itertoolz as itz, functoolz as ftz
 
+from OSM_Processing import DEFAULT_FILENAME, build_graph
 from output_mgr import build_map, write_paths_csv
 from shortest_path import (
-    mgr, adj_list, nodes, find_nearest_way_connections,
-    random_nodeid, calculate_dists, expand_path)
+    use_graph, find_nearest_way_connections, random_nodeid, calculate_dists, expand_path)
 from pathfinding_algorithms import dijkstra, IndexedQueue, Path
 from tsp_nn import nearest_neighbor
 from tsp_sim_annealing import simulated_annealing#, plot_last as sim_ann_plot
 from miscellaneous import pairwise, timed
 
+# The road graph, see `init_graph`
+mgr = nodes = None
+
+def init_graph(filename=DEFAULT_FILENAME):
+    global mgr, nodes
+    mgr = use_graph(build_graph(filename))
+    nodes = mgr.nodes
+
 def init_spots(additional={}):
     "`Spots` and sth. else may be disconnected from roads."
+    from csr_graph import CSRGraph
     global spots, all_dists
     spots = dict(itz.take(10, sorted(mgr.spots.items(), key=lambda id_nd: id_nd[1]['x'])))
     nodes.update(spots)
     nodes.update(additional)
     find_nearest_way_connections({**spots, **additional})
-    all_dists = calculate_dists()
+    all_dists = CSRGraph.from_dists(calculate_dists())
 
 
 def run_algorithm(func, start, paths, draw_map=False, label=None):
@@ -52,9 +61,9 @@ def demo_city(start=None):
     while True:
         if randomly:
             start = random_nodeid() 
-        if dijkstra(all_dists, start, spots.keys()):
+        if dijkstra(all_dists, start, spots.keys(), restrictions=mgr.restrictions):
             dests = (start,)+tuple(spots.keys())
-            paths = {begin:dijkstra(all_dists, begin, dests) for begin in dests}
+            paths = {begin:dijkstra(all_dists, begin, dests, restrictions=mgr.restrictions) for begin in dests}
             break
         elif not randomly:
             raise Exception('Unreachable start node')
@@ -68,6 +77,7 @@ def demo_city(start=None):
 
 
 if __name__ == '__main__':
+    init_graph()
     if len(argv) >= 1 and argv[-1].isdecimal() and int(argv[-1]) in nodes:
         init_spots()
         demo_city(int(argv[-1]))
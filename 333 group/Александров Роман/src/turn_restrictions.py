@@ -0,0 +1,118 @@
+from collections import defaultdict
+
+import osmread as osm
+
+EMPTY = frozenset()
+
+
+class TurnRestrictions(object):
+    '''
+    Via-node turn restrictions of the road graph: `forbidden` maps
+    (prev, via) to the nodes one can't go to from `via` after coming from
+    `prev`; "only_*" restrictions are stored as the neighbors they forbid.
+    `vias` are the nodes where the previous node matters, so the search
+    algorithms tell their states apart by it.
+    '''
+
+    def __init__(self, forbidden=None):
+        self.forbidden = {turn: frozenset(nexts) for turn, nexts in (forbidden or {}).items() if nexts}
+        self.vias = frozenset(via for _, via in self.forbidden)
+
+    def banned(self, prev, via):
+        "Nodes one can't go to from `via` after `prev`"
+        return self.forbidden.get((prev, via), EMPTY)
+
+    def split(self, a, b, c):
+        '''
+        The restrictions after node `c` is put on the edge between `a` and
+        `b`: at a via node on either end, going to `c` is banned where going
+        on to the other end was, and coming from `c` is coming from the other
+        end. A new TurnRestrictions, the searches cache them by identity.
+        '''
+        forbidden = dict(self.forbidden)
+        for via, other in ((a, b), (b, a)):
+            if via not in self.vias:
+                continue
+            if (other, via) in forbidden:
+                forbidden[c, via] = forbidden[other, via]
+            for turn in [turn for turn, nexts in forbidden.items() if turn[1] == via and other in nexts]:
+                forbidden[turn] |= {c}
+        return TurnRestrictions(forbidden)
+
+    def __len__(self):
+        return len(self.forbidden)
+
+    def __repr__(self):
+        return '<TurnRestrictions: {} turns at {} nodes>'.format(len(self), len(self.vias))
+
+
+def _neighbors(ways, via, graph_nodes):
+    "Closest graph nodes on both sides of `via` along `ways`"
+    found = set()
+    for ww in ways:
+        nodes = list(ww.nodes)
+        for i, nd_id in enumerate(nodes):
+            if nd_id != via:
+                continue
+            found.update(next((nd for nd in side if nd in graph_nodes), None)
+                         for side in (reversed(nodes[:i]), nodes[i+1:]))
+    found.discard(None)
+    return found
+
+
+def _turns(kind, from_id, to_id, from_sides, to_sides):
+    '''
+    (prev, nexts) pairs the restriction is about, `from_sides` and
+    `to_sides` being the graph nodes next to the via node along the from
+    and to ways. A way passing through the via node (it should start or
+    end there) has a node on both sides: the one `prev` is on is the way
+    back, and a from way like that only tells the direction when it is
+    the to way as well; the turns that can't be told are left out.
+    '''
+    if kind in ('no_u_turn', 'only_u_turn'):
+        return [(prev, {prev}) for prev in from_sides]
+    if from_id != to_id and len(from_sides) > 1:
+        return []
+    turns = []
+    for prev in from_sides:
+        nexts = to_sides - {prev}
+        if len(nexts) == 1:
+            turns.append((prev, nexts))
+    return turns
+
+
+def build_restrictions(relations, ways, adj_list, graph_nodes):
+    '''
+    Builds the index out of `type=restriction` relations with a node as
+    `via`. `graph_nodes` are the nodes of `adj_list`; from and to ways are
+    replaced with the graph nodes next to `via` along them (see _turns).
+    Restrictions with a way as `via` are skipped.
+    '''
+    ways_by_id = defaultdict(list)
+    for ww in ways:
+        ways_by_id[ww.id].append(ww)
+
+    forbidden = defaultdict(set)
+    for rel in relations:
+        kind = rel.tags.get('restriction', '')
+        if not kind.startswith(('no_', 'only_')):
+            continue
+        roles = defaultdict(list)
+        for member in rel.members:
+            roles[member.role].append(member)
+        if not (len(roles['from']) == len(roles['via']) == len(roles['to']) == 1) \
+                or roles['via'][0].type is not osm.Node:
+            continue
+
+        from_id, via, to_id = (roles[role][0].member_id for role in ('from', 'via', 'to'))
+        if via not in graph_nodes:
+            continue
+        from_sides = _neighbors(ways_by_id[from_id], via, graph_nodes)
+        to_sides = _neighbors(ways_by_id[to_id], via, graph_nodes)
+        for prev, targets in _turns(kind, from_id, to_id, from_sides, to_sides):
+            if kind.startswith('no_'):
+                forbidden[prev, via] |= targets
+            else:
+                forbidden[prev, via] |= adj_list.get(via, set()) - targets
+
+    return TurnRestrictions(forbidden)